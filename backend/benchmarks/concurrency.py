@@ -0,0 +1,119 @@
+"""
+Concurrency benchmark of the thread mode against the gevent mode, over HTTP.
+
+Every mode is served by backend.benchmarks.server in its own process, backend.serve_gevent for the gevent mode and
+the werkzeug server with a pool of --threads threads for the thread mode. Every request waits on PostgreSQL
+(`SELECT pg_sleep(--wait)`), like most of the API requests do, and both modes share the same connection pool size.
+The requests are sent by --concurrency clients at once, greenlets of this process.
+
+    # from the main repository directory, with the .env of the app
+    python -m backend.benchmarks.concurrency --mode both --requests 2000 --concurrency 1000
+"""
+from gevent import monkey
+
+# the clients are greenlets, it has to happen before anything else imports socket, threading or ssl
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import socket  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from urllib.error import URLError  # noqa: E402
+from urllib.request import urlopen  # noqa: E402
+
+from gevent.pool import Pool  # noqa: E402
+
+HOST = '127.0.0.1'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['thread', 'gevent', 'both'], default='both')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests sent.')
+    parser.add_argument('--concurrency', type=int, default=1000, help='Concurrent clients.')
+    parser.add_argument('--threads', type=int, default=32, help='Threads of the thread mode.')
+    parser.add_argument('--pool', type=int, default=50, help='Database connection pool size of both modes.')
+    parser.add_argument('--wait', type=float, default=0.05, help='Seconds every request waits on the database.')
+    return parser.parse_args()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(server: subprocess.Popen, url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"the server exited with {server.returncode}")
+        try:
+            with urlopen(f"{url}/api/health/ready", timeout=5):
+                return
+        except (URLError, OSError):
+            time.sleep(0.2)
+    raise RuntimeError(f"the server wasn't ready after {timeout} seconds")
+
+
+def _run(mode: str, args) -> dict:
+    port = _free_port()
+    url = f"http://{HOST}:{port}"
+    argv = [
+        sys.executable, '-m', 'backend.benchmarks.server', mode, '--host', HOST, '--port', str(port),
+        '--threads', str(args.threads), '--connections', str(args.concurrency),
+        '--pool', str(args.pool), '--wait', str(args.wait),
+    ]
+    # the access logs of both servers would only slow them down
+    server = subprocess.Popen(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_until_ready(server, url)
+
+        latencies = []
+
+        def request():
+            start = time.perf_counter()
+            with urlopen(f"{url}/bench/wait", timeout=600) as response:
+                assert response.status == 200
+                response.read()
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        pool = Pool(args.concurrency)
+        for _ in range(args.requests):
+            pool.spawn(request)
+        pool.join(raise_error=True)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'requests': args.requests,
+        'seconds': round(elapsed, 3),
+        'throughput': round(args.requests / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+def main():
+    args = _parse_args()
+    if args.mode != 'both':
+        print(json.dumps(_run(args.mode, args)))
+        return
+
+    results = [_run(mode, args) for mode in ('thread', 'gevent')]
+
+    print(f"{'mode':<8}{'requests':>10}{'seconds':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['mode']:<8}{r['requests']:>10}{r['seconds']:>10}{r['throughput']:>10}{r['p50_ms']:>10}{r['p99_ms']:>10}")
+    print(f"gevent mode serves {results[1]['throughput'] / results[0]['throughput']:.1f}x the requests of the thread mode")
+
+
+if __name__ == '__main__':
+    main()
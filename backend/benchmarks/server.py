@@ -0,0 +1,89 @@
+"""
+Server of the concurrency benchmark, started by backend.benchmarks.concurrency in its own process:
+
+    python -m backend.benchmarks.server gevent --port 5001 --pool 50 --wait 0.05
+    python -m backend.benchmarks.server thread --port 5001 --pool 50 --wait 0.05 --threads 32
+
+The gevent mode is backend.serve_gevent itself, the thread mode is the werkzeug server of `flask run` with a fixed
+pool of threads. Both serve the app with an extra /bench/wait route waiting on PostgreSQL.
+"""
+import sys
+
+if sys.argv[1:2] == ['gevent']:
+    # importing it patches the standard library, before anything else imports socket, threading or ssl
+    from backend import serve_gevent  # noqa: F401
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+
+from flask import jsonify  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from werkzeug.serving import BaseWSGIServer  # noqa: E402
+
+from backend.models import db  # noqa: E402
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    PooledWSGIServer(host, port, app, threads)
+        werkzeug server handling the requests in a pool of threads, at most threads requests at once
+        like a threaded WSGI server (gunicorn gthread, uwsgi threads) does
+    """
+
+    def __init__(self, host: str, port: int, app, threads: int):
+        super().__init__(host, port, app)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', choices=['thread', 'gevent'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--threads', type=int, default=32, help='Threads of the thread mode.')
+    parser.add_argument('--connections', type=int, default=2000, help='Max concurrent requests of the gevent mode.')
+    parser.add_argument('--pool', type=int, default=50, help='Database connection pool size.')
+    parser.add_argument('--wait', type=float, default=0.05, help='Seconds every request waits on the database.')
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    if args.mode == 'gevent':
+        app = serve_gevent.app
+    else:
+        from backend.flaskr import create_app
+
+        os.environ.setdefault('APP_SETTINGS', '.env')
+        app = create_app()
+    # the engine is created with the first connection, both modes get the same pool
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': args.pool, 'max_overflow': 0, 'pool_timeout': 600}
+
+    @app.route('/bench/wait')
+    def wait():
+        db.session.execute(text('SELECT pg_sleep(:wait)'), {'wait': args.wait})
+        return jsonify({'ok': True})
+
+    if args.mode == 'gevent':
+        serve_gevent.serve(args.host, args.port, args.connections)
+        return
+
+    app.extensions['warmup'].start()
+    print(f" * Serving with {args.threads} threads on http://{args.host}:{args.port}")
+    PooledWSGIServer(args.host, args.port, app, args.threads).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
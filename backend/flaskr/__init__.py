@@ -3,17 +3,33 @@ from pathlib import Path
 from re import match
 
 from dotenv import load_dotenv
-from flask import Flask, Response, request, jsonify
-from werkzeug.exceptions import InternalServerError
+from flask import Flask, Response, request
+from werkzeug.exceptions import InternalServerError, NotFound
 from flask_cors import CORS
 from flask_migrate import Migrate
-from sqlalchemy import func
 from sqlalchemy.exc import SQLAlchemyError
 
-from backend.models import setup_db, Category, Question
+from backend.models import setup_db, Category, CategoryStats, Job, PlayerScore, Question, QuestionStats
+from backend.flaskr.batch import validate_batch, batch_cost, run_batch
+from backend.flaskr.cache import create_cache
+from backend.flaskr.dedupe import dedupe_cli, find_exact, find_similar, index_question
+from backend.flaskr.events import track_question_writes, on_questions_changed
+from backend.flaskr.formats import render
+from backend.flaskr.ingest import create_answer_buffer
+from backend.flaskr.jobs import create_job_queue, jobs_cli, validate_job
+from backend.flaskr.perf import perf_cli
+from backend.flaskr.profiling import init_profiling
+from backend.flaskr import queries
+from backend.flaskr.seed import seed_cli
+from backend.flaskr.slow_queries import init_slow_queries
+from backend.flaskr.snapshots import create_snapshot_publisher, snapshots_cli
+from backend.flaskr.stats import create_category_stats_refresher, stats_cli
+from backend.flaskr.tenants import TENANT_HEADER, current_tenant, init_tenants
+from backend.flaskr.warmup import create_warmup
 
 flaskr_dir_path = Path(__file__).parent
 QUESTIONS_PER_PAGE = 10
+MAX_PLAYER_LENGTH = 100
 
 
 def create_app(test_env: str = None):
@@ -43,6 +59,47 @@ def create_app(test_env: str = None):
         # to make sure migrations inside backend folder
         directory=Path(flaskr_dir_path.parent, 'migrations').absolute()
     )
+    app.cli.add_command(perf_cli)
+    app.cli.add_command(dedupe_cli)
+    app.cli.add_command(snapshots_cli)
+    app.cli.add_command(stats_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(seed_cli)
+
+    # every request belongs to a tenant, the default one unless its X-Tenant header or its subdomain tells otherwise
+    known_tenants = init_tenants(app)
+
+    # search result pages are cached per tenant until the next write to the tenant questions
+    search_cache = create_cache(app.config, known_tenants)
+    app.extensions['search_cache'] = search_cache
+    track_question_writes()
+    on_questions_changed(app, lambda category_ids, tenants: search_cache.bump(tenants))
+
+    # static JSON files of the shared GET responses, published again after writes
+    snapshots = create_snapshot_publisher(app)
+    if snapshots is not None:
+        app.extensions['snapshots'] = snapshots
+        on_questions_changed(app, snapshots.invalidate)
+
+    # the category aggregates are read from category_stats, refreshed in the background after writes
+    category_stats = create_category_stats_refresher(app)
+    app.extensions['category_stats'] = category_stats
+    on_questions_changed(app, category_stats.invalidate)
+
+    answer_buffer = create_answer_buffer(app)
+    app.extensions['answer_buffer'] = answer_buffer
+
+    # maintenance operations run in the background, in chunks
+    jobs = create_job_queue(app)
+    app.extensions['jobs'] = jobs
+
+    # the connections, queries and caches are warmed up before the worker reports ready
+    warmup = create_warmup(app)
+    app.extensions['warmup'] = warmup
+
+    profiler = init_profiling(app)
+    app.extensions['profiler'] = profiler
+    slow_queries = init_slow_queries(app)
 
     # @DONE: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     cors = CORS(app, resources={
@@ -53,7 +110,7 @@ def create_app(test_env: str = None):
     @app.after_request
     def after_request(response: Response):
         if match(r'^/api/*', request.path):  # to make sure it's only allowed for api endpoints
-            response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+            response.headers.add('Access-Control-Allow-Headers', f"Content-Type, {TENANT_HEADER}")
             response.headers.add('Access-Control-Allow-Methods', 'GET, POST, PATCH, DELETE')
         return response
 
@@ -64,13 +121,42 @@ def create_app(test_env: str = None):
         Create an endpoint to handle GET requests
         for all available categories.
         """
-        categories = Category.query.all()
+        categories = queries.categories(current_tenant()).all()
 
         res = {
-            'categories': {c.id: c.type for c in categories}
+            'categories': {str(c.id): c.type for c in categories}
         }
 
-        return jsonify(res)
+        return render(res)
+
+    @app.route('/api/categories/<int:category_id>', methods=['DELETE'])
+    def delete_category(category_id):
+        """
+        Delete a category with its questions, in a background job since it can be a lot of questions.
+        """
+        queries.category(current_tenant(), category_id).first_or_404()
+        try:
+            job = jobs.submit('delete_category', {'category_id': category_id}, current_tenant())
+        except SQLAlchemyError:
+            db.session.rollback()
+            db.session.close()
+            raise InternalServerError
+
+        return render({
+            'job': job.format(),
+        }), 202
+
+    @app.route('/api/categories/stats')
+    def get_categories_stats():
+        """
+        Get the questions count, average difficulty and difficulty histogram of every category,
+        they're refreshed in the background so they can lag the last writes by a few seconds.
+        """
+        stats = queries.category_stats(current_tenant()).all()
+
+        return render({
+            'categories': [s.format() for s in stats],
+        }, columns={'categories': CategoryStats.COLUMNS})
 
     @app.route('/api/questions')
     def get_questions():
@@ -87,17 +173,17 @@ def create_app(test_env: str = None):
         Clicking on the page numbers should update the questions.
         """
 
-        questions = Question.query.paginate(per_page=QUESTIONS_PER_PAGE)
-        categories = Category.query.all()
+        questions = queries.questions(current_tenant()).paginate(per_page=QUESTIONS_PER_PAGE)
+        categories = queries.categories(current_tenant()).all()
 
         data = {
             'questions': [q.format() for q in questions.items],
             'total_questions': questions.total,
-            'categories': {c.id: c.type for c in categories},
+            'categories': {str(c.id): c.type for c in categories},
             'current_category': None,
         }
 
-        return jsonify(data)
+        return render(data, columns={'questions': Question.COLUMNS})
 
     @app.route('/api/questions/<question_id>', methods=['DELETE'])
     def delete_question(question_id):
@@ -109,7 +195,7 @@ def create_app(test_env: str = None):
         This removal will persist in the database and when you refresh the page.
         """
 
-        question = Question.query.get_or_404(question_id)
+        question = queries.question(current_tenant(), question_id).first_or_404()
         try:
             db.session.delete(question)
             db.session.commit()
@@ -142,30 +228,39 @@ def create_app(test_env: str = None):
 
         # Simple validation
         all_values_exist = all([question, answer, category, difficulty])
-        category_exist = db.session.query(Category.query.filter_by(id=category).exists()).scalar()
+        is_unique = not question or not find_exact(question, current_tenant())
+        category_exist = queries.category_exists(current_tenant(), category).scalar()
         difficulty_in_range = 1 <= difficulty <= 5
 
-        if not all([all_values_exist, category_exist, difficulty_in_range]):
+        if not all([all_values_exist, is_unique, category_exist, difficulty_in_range]):
             message = ""
             if not all_values_exist:
                 message = "There is an empty required field. "
+            if not is_unique:
+                message += "Question already exists. "
             if not category_exist:
                 message += "Category doesn't exist. "
             if not difficulty_in_range:
                 message += "Difficulty range is between 1 to 5."
-            return jsonify({
+            return render({
                 'message': message
             }), 422
 
+        # near duplicates are only reported, the similarity can't tell a rephrasing from a different question
+        similar = find_similar(question, current_tenant(), app.config.get('DEDUPE_SIMILARITY', 0.8))
+
         question_model = Question(
             question=question,
             answer=answer,
             category_id=category,
-            difficulty=difficulty
+            difficulty=difficulty,
+            tenant=current_tenant(),
         )
 
         try:
             db.session.add(question_model)
+            db.session.flush()
+            index_question(question_model)
             db.session.commit()
             _id = question_model.id
         except SQLAlchemyError:
@@ -173,9 +268,10 @@ def create_app(test_env: str = None):
             db.session.close()
             raise InternalServerError
 
-        return jsonify({
+        return render({
             'id': _id,
-        }), 201
+            'similar_questions': [{'id': s_id, 'similarity': similarity} for s_id, similarity in similar],
+        }, columns={'similar_questions': ('id', 'similarity')}), 201
 
     @app.route('/api/questions/search', methods=['POST'])
     def search_question():
@@ -191,17 +287,24 @@ def create_app(test_env: str = None):
         """
         data = request.get_json()
         q = data.get('q') or ''
-        questions = Question.query.filter(
-            Question.question.ilike(f"%{q}%")
-        ).paginate(page=data.get('page') or 1, per_page=QUESTIONS_PER_PAGE)
+        page = int(data.get('page') or 1)
+
+        tenant = current_tenant()
+        cache_key = search_cache.key(tenant, search_cache.normalize(q), page)
+        cached = search_cache.get(tenant, cache_key)
+        if cached is not None:
+            return render(cached, columns={'questions': Question.COLUMNS})
+
+        questions = queries.search_questions(tenant, q).paginate(page=page, per_page=QUESTIONS_PER_PAGE)
 
         data = {
             'questions': [q.format() for q in questions.items],
             'total_questions': questions.total,
             'current_category': None,
         }
+        search_cache.set(tenant, cache_key, data)
 
-        return jsonify(data)
+        return render(data, columns={'questions': Question.COLUMNS})
 
     @app.route('/api/categories/<category_id>/questions')
     def get_questions_by_category(category_id):
@@ -213,15 +316,15 @@ def create_app(test_env: str = None):
         categories in the left column will cause only questions of that
         category to be shown.
         """
-        category: Category = Category.query.get_or_404(category_id)
-        questions = Question.query.filter_by(category_id=category_id).paginate(per_page=QUESTIONS_PER_PAGE)
+        category: Category = queries.category(current_tenant(), category_id).first_or_404()
+        questions = queries.questions_in_category(current_tenant(), category_id).paginate(per_page=QUESTIONS_PER_PAGE)
         data = {
             'questions': [q.format() for q in questions.items],
             'total_questions': questions.total,
             'current_category': category_id
         }
 
-        return jsonify(data)
+        return render(data, columns={'questions': Question.COLUMNS})
 
     @app.route('/api/quizzes', methods=['POST'])
     def quizzes_handler():
@@ -241,16 +344,222 @@ def create_app(test_env: str = None):
         quiz_category = data.get('quiz_category')
         previous_questions = data.get('previous_questions') or []
 
-        questions = Question.query
-        if quiz_category:
-            questions = questions.filter_by(category_id=quiz_category)
-        question = questions.filter(Question.id.notin_(previous_questions)).order_by(func.random()).first()
+        question = queries.quiz_question(current_tenant(), quiz_category, previous_questions).first()
 
         data = {
             'question': question.format() if question else None
         }
 
-        return jsonify(data)
+        return render(data)
+
+    @app.route('/api/quizzes/answers', methods=['POST'])
+    def post_answers():
+        """
+        Record the answers of a quiz player, they are buffered and written in batches
+        so the response doesn't wait for the database.
+        """
+        data: dict = request.get_json() or {}
+
+        player = data.get('player')
+        answers = data.get('answers')
+
+        valid_answers = isinstance(answers, list) and len(answers) > 0 and all(
+            isinstance(a, dict) and isinstance(a.get('question_id'), int) and isinstance(a.get('correct'), bool)
+            for a in answers
+        )
+        # PostgreSQL can't store a NUL character, it would fail the whole batch of answers
+        valid_player = isinstance(player, str) and player.strip() and len(player.strip()) <= MAX_PLAYER_LENGTH and (
+            '\x00' not in player
+        )
+        if not valid_player or not valid_answers:
+            message = ""
+            if not (isinstance(player, str) and player.strip()):
+                message = "Player is required. "
+            elif not valid_player:
+                message = f"Player should be at most {MAX_PLAYER_LENGTH} characters, without NUL characters. "
+            if not valid_answers:
+                message += "Answers should be a list of question_id and correct."
+            return render({
+                'message': message
+            }), 422
+
+        # only the questions of the tenant can be answered, the rollups would count unknown ids otherwise
+        question_ids = {a['question_id'] for a in answers}
+        unknown = question_ids - {_id for _id, in queries.question_ids(current_tenant(), question_ids)}
+        if unknown:
+            return render({
+                'message': f"Questions {', '.join(str(_id) for _id in sorted(unknown))} don't exist."
+            }), 422
+
+        if not answer_buffer.add(player.strip(), [(a['question_id'], a['correct']) for a in answers], current_tenant()):
+            # backpressure, the answers can't be written as fast as they come
+            return render({
+                'message': "Too many pending answers, retry later."
+            }), 503, {'Retry-After': str(max(1, round(answer_buffer.flush_interval)))}
+
+        return render({
+            'accepted': len(answers),
+        }), 202
+
+    @app.route('/api/questions/accuracy')
+    def get_questions_accuracy():
+        """
+        Get the answers accuracy per question from the rollups, hardest questions first.
+        """
+        stats = queries.questions_accuracy(current_tenant()).paginate(per_page=QUESTIONS_PER_PAGE)
+
+        data = {
+            'questions': [{**q.format(), **s.format()} for q, s in stats.items],
+            'total_questions': stats.total,
+        }
+
+        return render(data, columns={'questions': Question.COLUMNS + QuestionStats.COLUMNS})
+
+    @app.route('/api/leaderboard')
+    def get_leaderboard():
+        """
+        Get the players with the most correct answers from the rollups.
+        Request Arguments: limit, 10 by default and at most 100
+        """
+        limit = max(0, min(request.args.get('limit', 10, type=int), 100))
+        scores = queries.leaderboard(current_tenant(), limit).all()
+
+        return render({
+            'leaderboard': [s.format() for s in scores],
+        }, columns={'leaderboard': PlayerScore.COLUMNS})
+
+    @app.route('/api/jobs', methods=['POST'])
+    def post_job():
+        """
+        Start a maintenance job, delete_category, recategorize or reindex_questions.
+        """
+        data: dict = request.get_json() or {}
+        kind = data.get('kind')
+        params = data.get('params') or {}
+
+        message = validate_job(kind, params, current_tenant())
+        if message:
+            return render({
+                'message': message
+            }), 422
+
+        try:
+            job = jobs.submit(kind, params, current_tenant())
+        except SQLAlchemyError:
+            db.session.rollback()
+            db.session.close()
+            raise InternalServerError
+
+        return render({
+            'job': job.format(),
+        }), 202
+
+    @app.route('/api/jobs')
+    def get_jobs():
+        """
+        Get the jobs, the last started first.
+        """
+        jobs_page = queries.jobs(current_tenant()).paginate(per_page=QUESTIONS_PER_PAGE)
+
+        return render({
+            'jobs': [j.format() for j in jobs_page.items],
+            'total_jobs': jobs_page.total,
+        }, columns={'jobs': Job.COLUMNS})
+
+    @app.route('/api/jobs/<int:job_id>')
+    def get_job(job_id):
+        """
+        Get the status and the progress of a job.
+        """
+        job = queries.job(current_tenant(), job_id).first_or_404()
+
+        return render({
+            'job': job.format(),
+        })
+
+    @app.route('/api/batch', methods=['POST'])
+    def post_batch():
+        """
+        Run several requests to the API at once, in order and sharing one database session,
+        and get all their responses together.
+        """
+        data: dict = request.get_json() or {}
+        sub_requests = data.get('requests')
+
+        message = validate_batch(app, sub_requests)
+        if not message and len(sub_requests) > int(app.config.get('BATCH_MAX_REQUESTS', 10)):
+            message = f"A batch has at most {app.config.get('BATCH_MAX_REQUESTS', 10)} requests."
+        if not message and batch_cost(app, sub_requests) > int(app.config.get('BATCH_MAX_COST', 20)):
+            message = "The batch is too expensive, split it."
+        if message:
+            return render({
+                'message': message
+            }), 422
+
+        return render({
+            'responses': run_batch(app, sub_requests),
+        })
+
+    @app.route('/api/health/live')
+    def get_liveness():
+        """
+        Whether the worker is alive, it doesn't touch the database.
+        """
+        return render({
+            'alive': True,
+        })
+
+    @app.route('/api/health/ready')
+    def get_readiness():
+        """
+        Whether the worker is warmed up and ready for traffic, 503 until then.
+        """
+        if not warmup.ready:
+            # retries a failed warm-up too
+            warmup.start()
+            return render(warmup.summary()), 503
+
+        return render(warmup.summary())
+
+    @app.route('/api/admin/profiles')
+    def get_profiles():
+        """
+        List the last profiled requests, it needs a valid X-Profile-Token header.
+        """
+        if not profiler.is_authorized():
+            raise NotFound
+
+        return render({
+            'profiles': profiler.summaries(),
+        })
+
+    @app.route('/api/admin/profiles/<int:profile_id>')
+    def get_profile(profile_id):
+        """
+        Download a profile as folded stacks for flame graphs, or with its SQL queries using ?format=json,
+        it needs a valid X-Profile-Token header.
+        """
+        profile = profiler.get(profile_id) if profiler.is_authorized() else None
+        if profile is None:
+            raise NotFound
+
+        if request.args.get('format') == 'json':
+            return render(profile)
+
+        return Response(profiler.folded(profile), mimetype='text/plain', headers={
+            'Content-Disposition': f"attachment; filename=profile-{profile_id}.folded",
+        })
+
+    @app.route('/api/admin/slow-queries')
+    def get_slow_queries():
+        """
+        Get the slow queries aggregated by fingerprint and the last ones recorded,
+        it needs a valid X-Profile-Token header.
+        """
+        if slow_queries is None or not profiler.is_authorized():
+            raise NotFound
+
+        return render(slow_queries.summary())
 
     '''
     @DONE: 
@@ -261,26 +570,26 @@ def create_app(test_env: str = None):
     # There is no need for this one for me
     @app.errorhandler(400)
     def handle_400(error):
-        return jsonify({
+        return render({
             "message": "Bad Request.",
         }), 400
 
     @app.errorhandler(404)
     def handle_404(error):
-        return jsonify({
+        return render({
             "message": "Not found.",
         }), 404
 
     # There is no need for this one for me
     @app.errorhandler(422)
     def handle_422(error):
-        return jsonify({
+        return render({
             "message": "Unprocessable Entity.",
         }), 422
 
     @app.errorhandler(500)
     def handle_500(error):
-        return jsonify({
+        return render({
             "message": "Internal Server Error.",
         }), 500
 
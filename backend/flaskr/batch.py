@@ -0,0 +1,84 @@
+from urllib.parse import unquote, urlsplit
+
+from flask import request
+from werkzeug.exceptions import HTTPException
+
+from backend.models import db
+
+METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+# relative cost of the routes, the others cost 1
+ROUTE_COSTS = {
+    'get_questions': 2,
+    'get_questions_by_category': 2,
+    'get_questions_accuracy': 2,
+    'quizzes_handler': 2,
+    'search_question': 4,
+    'add_question': 4,
+}
+# the routes that can't run within a batch
+_UNBATCHABLE = ('post_batch', 'get_profiles', 'get_profile', 'get_slow_queries')
+# the headers of the batch request that aren't passed to its sub-requests
+_OWN_HEADERS = ('Accept', 'Content-Type', 'Content-Length')
+
+
+def _endpoint(adapter, sub) -> str:
+    """
+    the endpoint the sub-request is dispatched to, matched on its decoded path like the dispatch does,
+    or None when it'll respond with 404 or 405 without doing anything
+    """
+    try:
+        endpoint, _ = adapter.match(unquote(urlsplit(sub['path']).path), method=sub.get('method', 'GET'))
+    except HTTPException:
+        return None
+    return endpoint
+
+
+def validate_batch(app, sub_requests) -> str:
+    """
+    the message of what's wrong with the sub-requests, or an empty one
+    """
+    if not isinstance(sub_requests, list) or not sub_requests:
+        return "Requests should be a non empty list."
+    adapter = app.url_map.bind('localhost')
+    for sub in sub_requests:
+        if not isinstance(sub, dict) or not isinstance(sub.get('path'), str):
+            return "Every request needs a path."
+        if sub.get('method', 'GET') not in METHODS:
+            return f"Method should be one of {', '.join(METHODS)}."
+        path = unquote(urlsplit(sub['path']).path)
+        if not path.startswith('/api/') or _endpoint(adapter, sub) in _UNBATCHABLE:
+            return f"{sub['path']} can't be batched."
+    return ""
+
+
+def batch_cost(app, sub_requests) -> int:
+    adapter = app.url_map.bind('localhost')
+    return sum(ROUTE_COSTS.get(_endpoint(adapter, sub), 1) for sub in sub_requests)
+
+
+def run_batch(app, sub_requests) -> list:
+    """
+    run_batch(app, sub_requests)
+        dispatches the sub-requests in order within the current app context, so they share its database session and
+        connection, with the headers of the batch request. Returns the status and the JSON body of each. The session
+        is rolled back after a failed sub-request, an aborted transaction would fail all the next ones.
+    """
+    headers = [(k, v) for k, v in request.headers if k not in _OWN_HEADERS]
+    responses = []
+    for sub in sub_requests:
+        url = urlsplit(sub['path'])
+        with app.test_request_context(
+            url.path, base_url=request.host_url, query_string=url.query, method=sub.get('method', 'GET'),
+            headers=headers, json=sub.get('body'),
+        ):
+            try:
+                response = app.full_dispatch_request()
+            except Exception as e:
+                response = app.make_response(app.handle_exception(e))
+            if response.status_code >= 500:
+                db.session.rollback()
+        responses.append({
+            'status': response.status_code,
+            'body': response.get_json(silent=True),
+        })
+    return responses
@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Set
+
+_MISSING = object()
+# the partition of the unknown tenants, it isn't a slug so it's never the partition of a tenant
+SHARED_PARTITION = '_shared'
+
+
+def _unlink(path: Path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class MemoryBackend:
+    """
+    MemoryBackend
+        bounded LRU store living in the current process, safe to share between threads
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def version(self) -> int:
+        return self._version
+
+    def bump(self) -> int:
+        with self._lock:
+            self._version += 1
+            # entries of the old version can't be reached anymore
+            self._entries.clear()
+            return self._version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _check_private(directory: Path):
+    """
+    the entries of a directory another user can write to could be planted by that user
+    """
+    st = directory.stat()
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise PermissionError(f"{directory} is owned by another user")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{directory} is writable by other users, it should be 0700")
+
+
+class FileBackend:
+    """
+    FileBackend
+        bounded LRU store in a directory, so every worker pointing at the same directory shares hits.
+        Entries are JSON files written atomically with os.replace and recency is tracked with the file mtime.
+        The data version is a random integer in a file replaced atomically by every bump, so concurrent bumps
+        from several processes can't lose one. The directory is private to the user running the app,
+        it's refused when another user owns it or can write to it.
+    """
+
+    def __init__(self, directory, max_size: int = 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        _check_private(self.directory)
+        self.max_size = max_size
+        self._version_path = Path(self.directory, 'version')
+
+    def _path(self, key: str) -> Path:
+        return Path(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def _write(self, path: Path, data: str):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            _unlink(Path(tmp_path))
+            raise
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                stored_key, entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return _MISSING
+        return entry if stored_key == key else _MISSING
+
+    def set(self, key: str, entry):
+        try:
+            self._write(self._path(key), json.dumps([key, entry]))
+        except OSError:
+            return
+        self._prune()
+
+    def delete(self, key: str):
+        _unlink(self._path(key))
+
+    def _entries(self):
+        return [p for p in self.directory.iterdir() if p.suffix == '.json']
+
+    def _prune(self):
+        entries = self._entries()
+        if len(entries) <= self.max_size:
+            return
+        mtimes = []
+        for p in entries:
+            try:
+                mtimes.append((p.stat().st_mtime, p))
+            except OSError:
+                pass
+        mtimes.sort()
+        for _, p in mtimes[:len(mtimes) - self.max_size]:
+            _unlink(p)
+
+    def version(self) -> int:
+        try:
+            return int(self._version_path.read_text())
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self) -> int:
+        # random rather than incremented, a read-modify-write could hand the same version to two bumps
+        version = int.from_bytes(os.urandom(8), 'big') >> 1
+        self._write(self._version_path, str(version))
+        return version
+
+    def clear(self):
+        for p in self._entries():
+            _unlink(p)
+
+
+class ResultCache:
+    """
+    ResultCache
+        caches rendered result pages, every key is tagged with the questions data version
+        so a write makes all the previous entries unreachable at once.
+    """
+
+    def __init__(self, backend=None, ttl: float = 60):
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+
+    @staticmethod
+    def normalize(q: str) -> str:
+        # the search is case-insensitive (ilike), but whitespace is part of the substring so it's kept as is
+        return (q or '').lower()
+
+    def key(self, *parts) -> str:
+        """
+        builds the key for parts tagged with the current data version,
+        build it before querying so a write landing in between can't get a stale page cached
+        """
+        return '\x1f'.join(str(p) for p in (self.backend.version(),) + parts)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.backend.get(key)
+        if entry is _MISSING:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            self.backend.delete(key)
+            return None
+        return value
+
+    def set(self, key: str, value):
+        self.backend.set(key, (time.time() + self.ttl, value))
+
+    def bump(self) -> int:
+        return self.backend.bump()
+
+    def clear(self):
+        self.backend.clear()
+
+
+class TenantCaches:
+    """
+    TenantCaches
+        one ResultCache per tenant, built by partition_factory(tenant), so the entries of a tenant are only ever
+        evicted by its own entries and a noisy tenant can't push everyone else's out. At most max_tenants partitions
+        are kept, the least recently used one is dropped as a whole. Every key is tagged with a shared root version
+        too, bumped when a write can't be attributed to tenants.
+        Only the tenants in known (every tenant without it) get a partition, the others share one, so requests
+        naming made up tenants can't create partitions and evict the real ones
+    """
+
+    def __init__(self, partition_factory, root_backend=None, max_tenants: int = 64, known=None):
+        self.partition_factory = partition_factory
+        self.root_backend = root_backend or MemoryBackend(0)
+        self.max_tenants = max_tenants
+        self.known = known
+        self._partitions = OrderedDict()
+        self._shared = None
+        self._lock = threading.Lock()
+
+    normalize = staticmethod(ResultCache.normalize)
+
+    def _is_known(self, tenant: str) -> bool:
+        return self.known is None or tenant in self.known
+
+    def partition(self, tenant: str) -> ResultCache:
+        return self._partition(tenant) if self._is_known(tenant) else self._shared_partition()
+
+    def _shared_partition(self) -> ResultCache:
+        # out of the least recently used ones, the unknown tenants can't evict a known one
+        with self._lock:
+            if self._shared is None:
+                self._shared = self.partition_factory(SHARED_PARTITION)
+            return self._shared
+
+    def _partition(self, tenant: str) -> ResultCache:
+        with self._lock:
+            partition = self._partitions.get(tenant)
+            if partition is None:
+                partition = self._partitions[tenant] = self.partition_factory(tenant)
+                while len(self._partitions) > self.max_tenants:
+                    # a memory partition is freed with it, a file one stays on disk for the other workers
+                    self._partitions.popitem(last=False)
+            else:
+                self._partitions.move_to_end(tenant)
+            return partition
+
+    def key(self, tenant: str, *parts) -> str:
+        if not self._is_known(tenant):
+            # the shared partition tells its tenants apart by key
+            return self._shared_partition().key(self.root_backend.version(), tenant, *parts)
+        return self._partition(tenant).key(self.root_backend.version(), *parts)
+
+    def get(self, tenant: str, key: str) -> Optional[Any]:
+        return self.partition(tenant).get(key)
+
+    def set(self, tenant: str, key: str, value):
+        self.partition(tenant).set(key, value)
+
+    def bump(self, tenants: Set[str] = None):
+        """
+        makes the entries of tenants unreachable, of every tenant when it's empty
+        """
+        if not tenants:
+            self.root_backend.bump()
+            with self._lock:
+                partitions = list(self._partitions.values()) + ([self._shared] if self._shared is not None else [])
+            # the entries of the old root version can't be reached anymore, they're only freed
+            for partition in partitions:
+                partition.clear()
+            return
+        # reads of the tenant may have been cached in the shared partition before its first category was known,
+        # so both are bumped and the tenants aren't looked up again
+        for tenant in tenants:
+            self._partition(tenant).bump()
+        if self.known is not None:
+            self._shared_partition().bump()
+
+    def clear(self):
+        with self._lock:
+            partitions = list(self._partitions.values()) + ([self._shared] if self._shared is not None else [])
+        for partition in partitions:
+            partition.clear()
+
+
+def create_cache(config, known_tenants=None) -> TenantCaches:
+    """
+    create_cache(app.config, known_tenants)
+        builds the search cache from SEARCH_CACHE_SIZE (entries per tenant), SEARCH_CACHE_TENANTS (tenants kept,
+        default 64), SEARCH_CACHE_TTL and SEARCH_CACHE_DIR, when SEARCH_CACHE_DIR is set the entries are shared
+        on disk between workers, in a directory per tenant. The tenants out of known_tenants share a partition
+    """
+    max_size = int(config.get('SEARCH_CACHE_SIZE', 256))
+    max_tenants = int(config.get('SEARCH_CACHE_TENANTS', 64))
+    ttl = float(config.get('SEARCH_CACHE_TTL', 60))
+    directory = config.get('SEARCH_CACHE_DIR')
+
+    if directory:
+        # tenants are slugs, so they're valid directory names
+        return TenantCaches(
+            lambda tenant: ResultCache(FileBackend(Path(directory, 'tenants', tenant), max_size), ttl),
+            root_backend=FileBackend(directory, 0),
+            max_tenants=max_tenants,
+            known=known_tenants,
+        )
+    return TenantCaches(
+        lambda tenant: ResultCache(MemoryBackend(max_size), ttl), max_tenants=max_tenants, known=known_tenants
+    )
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import random
+import struct
+import zlib
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, or_, exists, func
+from sqlalchemy.orm import aliased
+
+from backend.models import db, Question, QuestionBand
+
+dedupe_cli = AppGroup('dedupe', help='Duplicate questions tooling.')
+
+SHINGLE_SIZE = 4
+BANDS = 16
+ROWS_PER_BAND = 4
+MAX_BUCKET_SIZE = 100
+# a new question is compared to the candidates sharing the most buckets with it, in buckets of at most
+# MAX_CANDIDATES_BUCKET_SIZE questions, so a family of templated questions doesn't make every insert slower
+MAX_CANDIDATES = 50
+MAX_CANDIDATES_BUCKET_SIZE = 10000
+_PRIME = (1 << 61) - 1
+_rng = random.Random(1337)
+# fixed, so the signatures stored in question_bands stay comparable between processes and releases
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(BANDS * ROWS_PER_BAND)]
+
+
+def shingles(text: str) -> set:
+    normalized = Question.normalize_text(text)
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def signature(text: str) -> list:
+    """
+    MinHash signature of the text shingles, BANDS * ROWS_PER_BAND values
+    """
+    hashes = [zlib.crc32(s.encode()) for s in shingles(text)]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def bands(text: str) -> list:
+    """
+    the (band, bucket) pairs of the text, two texts with a Jaccard similarity s share at least one
+    with a probability of 1 - (1 - s^ROWS_PER_BAND)^BANDS, about 0.9999 for 0.8 and 0.1 for 0.2
+    """
+    sig = signature(text)
+    result = []
+    for band in range(BANDS):
+        values = sig[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(struct.pack(f'>{ROWS_PER_BAND}Q', *values), digest_size=8).digest()
+        # a signed 64 bits integer to fit a BIGINT column
+        result.append((band, struct.unpack('>q', digest)[0]))
+    return result
+
+
+def index_question(question: Question):
+    """
+    adds the question LSH buckets to the session, the question needs an id so flush it first
+    """
+    db.session.add_all(QuestionBand(band, bucket, question.id) for band, bucket in bands(question.question))
+
+
+def exact_duplicates(text: str, tenant: str, exclude_id: int = None):
+    query = Question.query.with_entities(Question.id).filter(
+        Question.tenant == tenant, Question.question_hash == Question.hash_text(text)
+    )
+    if exclude_id is not None:
+        query = query.filter(Question.id != exclude_id)
+    return query
+
+
+def find_exact(text: str, tenant: str, exclude_id: int = None) -> list:
+    return [_id for _id, in exact_duplicates(text, tenant, exclude_id)]
+
+
+def similar_candidates(text: str, tenant: str, exclude_id: int = None,
+                       max_bucket_size: int = MAX_CANDIDATES_BUCKET_SIZE, limit: int = MAX_CANDIDATES):
+    """
+    the (id, question) of at most limit tenant questions sharing an LSH bucket with text, the ones sharing the most
+    buckets first, the buckets of more than max_bucket_size questions are skipped. The ranking is done by the database
+    on the (band, bucket) primary key, only the candidates are loaded and compared
+    """
+    buckets = or_(*(and_(QuestionBand.band == band, QuestionBand.bucket == bucket) for band, bucket in bands(text)))
+    small = db.session.query(QuestionBand.band, QuestionBand.bucket).filter(buckets).group_by(
+        QuestionBand.band, QuestionBand.bucket
+    ).having(func.count() <= max_bucket_size).subquery()
+    shared = db.session.query(QuestionBand.question_id, func.count().label('bands')).join(
+        small, and_(QuestionBand.band == small.c.band, QuestionBand.bucket == small.c.bucket)
+    ).group_by(QuestionBand.question_id).subquery()
+    candidates = db.session.query(Question.id, Question.question).join(
+        shared, shared.c.question_id == Question.id
+    ).filter(Question.tenant == tenant)
+    if exclude_id is not None:
+        candidates = candidates.filter(Question.id != exclude_id)
+    return candidates.order_by(shared.c.bands.desc(), Question.id).limit(limit)
+
+
+def find_similar(text: str, tenant: str, threshold: float = 0.8, exclude_id: int = None) -> list:
+    """
+    find_similar(text, tenant)
+        the ids and similarities of the tenant questions whose shingles Jaccard similarity with text is at least
+        threshold, only the questions sharing an LSH bucket with text are compared so it doesn't depend
+        on the table size
+    """
+    text_shingles = shingles(text)
+    similar = []
+    for _id, question in similar_candidates(text, tenant, exclude_id):
+        similarity = jaccard(text_shingles, shingles(question))
+        if similarity >= threshold:
+            similar.append((_id, round(similarity, 3)))
+    return sorted(similar, key=lambda s: s[1], reverse=True)
+
+
+def questions_to_index(rebuild: bool = False, tenant: str = None):
+    """
+    the questions (of tenant, of every tenant without it) missing their hash or LSH buckets, every one with rebuild
+    """
+    query = Question.query
+    if tenant is not None:
+        query = query.filter(Question.tenant == tenant)
+    if not rebuild:
+        indexed = exists().where(QuestionBand.question_id == Question.id)
+        query = query.filter(or_(Question.question_hash.is_(None), ~indexed))
+    return query
+
+
+def index_batches(batch_size: int = 1000, rebuild: bool = False, tenant: str = None):
+    """
+    index_batches()
+        computes the hashes and LSH buckets of questions_to_index(rebuild, tenant) batch by batch, yielding the size of
+        every batch once it's in the session, committing is up to the caller so each batch is a short transaction
+    """
+    last_id = 0
+    while True:
+        # keyset pagination, so every batch is an index range scan whatever the table size is
+        batch = questions_to_index(rebuild, tenant).filter(Question.id > last_id).order_by(Question.id).limit(
+            batch_size
+        ).all()
+        if not batch:
+            break
+
+        for question in batch:
+            question.question_hash = Question.hash_text(question.question)
+        QuestionBand.query.filter(QuestionBand.question_id.in_([q.id for q in batch])).delete(
+            synchronize_session=False
+        )
+        db.session.bulk_insert_mappings(QuestionBand, [
+            {'band': band, 'bucket': bucket, 'question_id': q.id} for q in batch for band, bucket in bands(q.question)
+        ])
+
+        last_id = batch[-1].id
+        yield len(batch)
+
+
+@dedupe_cli.command('index')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--rebuild', is_flag=True, help='Recompute the hashes and buckets of every question.')
+def index(batch_size, rebuild):
+    """Fill the text hashes and LSH buckets of the questions missing them."""
+    total = 0
+    for indexed in index_batches(batch_size, rebuild):
+        db.session.commit()
+        total += indexed
+        click.echo(f"indexed {total} questions", err=True)
+
+
+def _exact_groups(batch_size: int):
+    # the same question in two tenants isn't a duplicate, grouped like the (tenant, question_hash) index
+    hashes = db.session.query(Question.tenant, Question.question_hash).filter(
+        Question.question_hash.isnot(None)
+    ).group_by(
+        Question.tenant, Question.question_hash
+    ).having(func.count() > 1).execution_options(stream_results=True).yield_per(batch_size)
+
+    chunk = []
+    for tenant, question_hash in hashes:
+        chunk.append((tenant, question_hash))
+        if len(chunk) == batch_size:
+            yield from _exact_groups_of(chunk)
+            chunk = []
+    if chunk:
+        yield from _exact_groups_of(chunk)
+
+
+def _exact_groups_of(keys: list):
+    groups = {key: [] for key in keys}
+    rows = db.session.query(Question.tenant, Question.question_hash, Question.id).filter(
+        Question.tenant.in_({tenant for tenant, _ in keys}),
+        Question.question_hash.in_({question_hash for _, question_hash in keys}),
+    )
+    for tenant, question_hash, _id in rows.order_by(Question.id):
+        if (tenant, question_hash) in groups:
+            groups[tenant, question_hash].append(_id)
+    for (tenant, question_hash), ids in groups.items():
+        # deleted meanwhile
+        if len(ids) > 1:
+            yield {'type': 'exact', 'tenant': tenant, 'hash': question_hash, 'ids': ids}
+
+
+def _near_pairs(threshold: float, batch_size: int, max_bucket_size: int = MAX_BUCKET_SIZE):
+    # a bucket of n questions is n * (n - 1) / 2 pairs, the crowded ones (a template shared by many questions)
+    # are skipped, near duplicates share most of their BANDS buckets so they are still found by the others
+    buckets = db.session.query(QuestionBand.band, QuestionBand.bucket).group_by(
+        QuestionBand.band, QuestionBand.bucket
+    ).having(func.count().between(2, max_bucket_size)).subquery()
+    a, b = aliased(QuestionBand), aliased(QuestionBand)
+    # the pairs sharing a bucket are found by the database with the (band, bucket) primary key
+    pairs = db.session.query(a.question_id, b.question_id).join(
+        buckets, and_(a.band == buckets.c.band, a.bucket == buckets.c.bucket)
+    ).join(
+        b, and_(a.band == b.band, a.bucket == b.bucket, a.question_id < b.question_id)
+    ).distinct().execution_options(stream_results=True).yield_per(batch_size)
+
+    chunk = []
+    for pair in pairs:
+        chunk.append(pair)
+        if len(chunk) == batch_size:
+            yield from _verified_pairs(chunk, threshold)
+            chunk = []
+    if chunk:
+        yield from _verified_pairs(chunk, threshold)
+
+
+def _verified_pairs(pairs: list, threshold: float):
+    ids = {_id for pair in pairs for _id in pair}
+    rows = db.session.query(Question.id, Question.question, Question.question_hash, Question.tenant).filter(
+        Question.id.in_(ids)
+    )
+    texts = {_id: (shingles(question), question_hash, tenant) for _id, question, question_hash, tenant in rows}
+    for first, second in pairs:
+        if first not in texts or second not in texts or texts[first][1] == texts[second][1]:
+            # deleted meanwhile, or already reported as an exact duplicate
+            continue
+        if texts[first][2] != texts[second][2]:
+            # questions of two tenants
+            continue
+        similarity = jaccard(texts[first][0], texts[second][0])
+        if similarity >= threshold:
+            yield {
+                'type': 'near', 'tenant': texts[first][2], 'ids': [first, second], 'similarity': round(similarity, 3)
+            }
+
+
+@dedupe_cli.command('report')
+@click.option('--threshold', default=0.8, show_default=True, help='Minimum similarity of near duplicates.')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--exact-only', is_flag=True, help='Skip the near duplicates.')
+@click.option('--max-bucket-size', default=MAX_BUCKET_SIZE, show_default=True,
+              help='Skip the LSH buckets shared by more questions.')
+def report(threshold, batch_size, exact_only, max_bucket_size):
+    """Print the duplicate questions as JSON lines, exact groups first then near duplicate pairs."""
+    count = 0
+    for group in _exact_groups(batch_size):
+        click.echo(json.dumps(group))
+        count += 1
+    if not exact_only:
+        for pair in _near_pairs(threshold, batch_size, max_bucket_size):
+            click.echo(json.dumps(pair))
+            count += 1
+    click.echo(f"{count} duplicate group(s) found", err=True)
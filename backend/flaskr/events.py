@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+from typing import Callable, Set
+
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect
+
+from backend.models import Category, Question
+
+
+def on_questions_changed(app, listener: Callable[[Set[int], Set[str]], None]):
+    """
+    registers listener(category_ids, tenants) to be called after every committed write to questions,
+    category_ids and tenants are the sets of the affected categories and tenants,
+    they're empty when they can't be known (bulk queries)
+    """
+    app.extensions.setdefault('questions_changed', []).append(listener)
+
+
+def _after_flush(session, flush_context):
+    touched = False
+    changed = set()
+    tenants = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Question):
+            touched = True
+            history = inspect(obj).attrs.category_id.history
+            changed.update(c for c in [obj.category_id, *history.deleted] if c is not None)
+            tenants.update(t for t in [obj.tenant, *inspect(obj).attrs.tenant.history.deleted] if t is not None)
+        elif isinstance(obj, Category) and obj in session.deleted:
+            # deleting a category cascades to its questions
+            touched = True
+            changed.add(obj.id)
+            tenants.add(obj.tenant)
+    if touched and not session.info.get('changed_unknown'):
+        session.info.setdefault('changed_categories', set()).update(changed)
+    if touched and not session.info.get('tenants_unknown'):
+        session.info.setdefault('changed_tenants', set()).update(tenants)
+
+
+def _after_bulk(update_context):
+    if update_context.mapper.class_ in (Question, Category):
+        info = update_context.session.info
+        # the affected rows aren't known, so all the categories are considered changed
+        info['changed_categories'] = set()
+        info['changed_unknown'] = True
+        if 'bulk_tenant' in info:
+            info.setdefault('changed_tenants', set()).add(info['bulk_tenant'])
+        else:
+            info['changed_tenants'] = set()
+            info['tenants_unknown'] = True
+
+
+def _after_commit(session):
+    changed = session.info.pop('changed_categories', None)
+    tenants = session.info.pop('changed_tenants', set())
+    if session.info.pop('changed_unknown', False):
+        changed = set()
+    if session.info.pop('tenants_unknown', False):
+        tenants = set()
+    if changed is None or not has_app_context():
+        return
+    for listener in current_app.extensions.get('questions_changed', ()):
+        listener(changed, tenants)
+
+
+def _after_rollback(session):
+    session.info.pop('changed_categories', None)
+    session.info.pop('changed_tenants', None)
+    session.info.pop('changed_unknown', None)
+    session.info.pop('tenants_unknown', None)
+
+
+@contextmanager
+def bulk_writes_of(session, tenant: str):
+    """
+    bulk_writes_of(session, tenant)
+        tells the listeners the bulk queries run meanwhile in session only touch the rows of tenant,
+        so they don't invalidate the other tenants
+    """
+    session.info['bulk_tenant'] = tenant
+    try:
+        yield
+    finally:
+        session.info.pop('bulk_tenant', None)
+
+
+def track_question_writes():
+    """
+    registers the session events that notify the questions_changed listeners after every committed write,
+    whatever the write path is (routes, model helpers, bulk queries or category cascades)
+    """
+    listeners = [
+        ('after_flush', _after_flush),
+        ('after_bulk_delete', _after_bulk),
+        ('after_bulk_update', _after_bulk),
+        ('after_commit', _after_commit),
+        ('after_rollback', _after_rollback),
+    ]
+    for name, fn in listeners:
+        if not event.contains(SignallingSession, name, fn):
+            event.listen(SignallingSession, name, fn)
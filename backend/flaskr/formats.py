@@ -0,0 +1,50 @@
+from flask import Response, request, jsonify
+
+try:
+    import msgpack
+except ImportError:  # optional, only JSON is served without it
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+def _columnar(data: dict, known_columns: dict) -> dict:
+    """
+    the lists of objects of data as parallel arrays, {'questions': {'id': [1, 2], 'question': ['...', '...']}},
+    starting with their known_columns so an empty list still has them
+    """
+    result = {}
+    for key, value in data.items():
+        if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+            columns = {column: [] for column in known_columns.get(key, ())}
+            for item in value:
+                for column in item:
+                    columns.setdefault(column, [])
+            for item in value:
+                for column, values in columns.items():
+                    values.append(item.get(column))
+            value = columns
+        result[key] = value
+    return result
+
+
+def render(data: dict, columns: dict = None):
+    """
+    render(data)
+        the response of data in the format negotiated from the Accept header, JSON unless MessagePack is preferred.
+        With ?layout=columnar the lists of objects are sent as parallel arrays, so their keys are sent once, columns
+        has the keys of the lists of objects ({'questions': Question.COLUMNS}) for the empty ones.
+        The objects keys have to be strings, like JSON ones, msgpack would keep integer keys as they are
+    """
+    if request.args.get('layout') == 'columnar':
+        data = _columnar(data, columns or {})
+
+    offered = [JSON, MSGPACK] if msgpack is not None else [JSON]
+    if request.accept_mimetypes.best_match(offered, default=JSON) == MSGPACK:
+        response = Response(msgpack.packb(data, use_bin_type=True), mimetype=MSGPACK)
+    else:
+        response = jsonify(data)
+    # shared caches have to keep one response per format
+    response.vary.add('Accept')
+    return response
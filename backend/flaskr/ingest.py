@@ -0,0 +1,205 @@
+import atexit
+import csv
+import threading
+import weakref
+from collections import Counter
+from datetime import datetime
+from io import StringIO
+
+from sqlalchemy import and_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, OperationalError, SQLAlchemyError
+
+from backend.green import is_green
+from backend.models import db, DEFAULT_TENANT, AnswerEvent, QuestionStats, PlayerScore
+
+
+# the buffers of the apps still alive, flushed once at exit
+_buffers = weakref.WeakSet()
+
+
+def _flush_all():
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+atexit.register(_flush_all)
+
+
+class AnswerBuffer:
+    """
+    AnswerBuffer
+        keeps the posted answers in memory and writes them in batches, when batch_size answers are pending
+        or every flush_interval seconds, so a busy quiz doesn't turn into one commit per answer.
+        A batch is appended to answer_events (with COPY on PostgreSQL) and its aggregated deltas are added
+        to the question_stats and player_scores rollups in the same transaction.
+        At most max_pending answers are kept, when the database can't keep up (or is down) new answers are refused.
+        A batch failing on a lost connection is retried with the next flush, a batch the database refuses is dropped
+    """
+
+    def __init__(self, app, batch_size: int = 500, flush_interval: float = 2, max_pending: int = 50000):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._lock = threading.Lock()
+        # only one batch is written at a time, so the rollups deltas never conflict
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        # answers of the batches refused by the database
+        self.dropped = 0
+        _buffers.add(self)
+
+    def add(self, player: str, answers: list, tenant: str = DEFAULT_TENANT) -> bool:
+        """
+        add(player, [(question_id, correct), ...], tenant)
+            queues the answers, the flush happens in the background. The answers of every tenant share the batches.
+            It's False, and nothing is queued, when the buffer is full
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            if len(self._pending) + len(answers) > self.max_pending:
+                return False
+            self._pending.extend((tenant, question_id, player, correct, now) for question_id, correct in answers)
+            full = len(self._pending) >= self.batch_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='answer-buffer', daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+        return True
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # the thread has to outlive any error, nothing would be flushed anymore
+                self.app.logger.exception('Flushing the answer events failed')
+
+    def flush(self) -> int:
+        """
+        writes every pending answer, returns how many were written
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as conn:
+                        self._append_events(conn, batch)
+                        self._update_rollups(conn, batch)
+            except SQLAlchemyError as e:
+                if not _is_transient(e):
+                    # it would be refused again and again, holding every other answer back
+                    self.dropped += len(batch)
+                    self.app.logger.exception(f"Dropped a batch of {len(batch)} answer events refused by the database")
+                    return 0
+                # put the batch back, so it's retried with the next flush
+                with self._lock:
+                    self._pending[:0] = batch
+                raise
+            return len(batch)
+
+    @staticmethod
+    def _append_events(conn, batch: list):
+        table = AnswerEvent.__table__
+        # psycopg2 can't COPY with a wait callback (green mode)
+        if conn.dialect.name != 'postgresql' or is_green():
+            conn.execute(table.insert(), [
+                {'tenant': tenant, 'question_id': q, 'player': p, 'correct': c, 'created_at': t}
+                for tenant, q, p, c, t in batch
+            ])
+            return
+
+        buffer = StringIO()
+        csv.writer(buffer).writerows(
+            (tenant, q, p, 't' if c else 'f', t.isoformat()) for tenant, q, p, c, t in batch
+        )
+        buffer.seek(0)
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {table.name} (tenant, question_id, player, correct, created_at) FROM STDIN WITH (FORMAT csv)",
+                buffer
+            )
+        except conn.dialect.dbapi.Error as e:
+            # the raw cursor errors, as SQLAlchemy would have wrapped them
+            raise DBAPIError.instance(None, None, e, conn.dialect.dbapi.Error) from e
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _update_rollups(conn, batch: list):
+        answered, correct = Counter(), Counter()
+        answered_by, correct_by = Counter(), Counter()
+        for tenant, question_id, player, is_correct, _ in batch:
+            answered[tenant, question_id] += 1
+            answered_by[tenant, player] += 1
+            if is_correct:
+                correct[tenant, question_id] += 1
+                correct_by[tenant, player] += 1
+
+        _add_to_rollup(conn, QuestionStats.__table__, ['tenant', 'question_id'], [
+            {'tenant': k[0], 'question_id': k[1], 'answered': v, 'correct': correct[k]}
+            for k, v in sorted(answered.items())
+        ])
+        _add_to_rollup(conn, PlayerScore.__table__, ['tenant', 'player'], [
+            {'tenant': k[0], 'player': k[1], 'answered': v, 'correct': correct_by[k]}
+            for k, v in sorted(answered_by.items())
+        ])
+
+
+def _is_transient(error: SQLAlchemyError) -> bool:
+    """
+    whether the error comes from the connection (the database is down or restarting) rather than from the data
+    """
+    return isinstance(error, OperationalError) or (isinstance(error, DBAPIError) and error.connection_invalidated)
+
+
+def _add_to_rollup(conn, table, keys: list, rows: list):
+    """
+    adds the answered and correct counts of rows to the rollup table, creating the missing keys
+    """
+    if conn.dialect.name == 'postgresql':
+        statement = postgresql.insert(table)
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={
+                'answered': table.c.answered + statement.excluded.answered,
+                'correct': table.c.correct + statement.excluded.correct,
+            }
+        ), rows)
+        return
+
+    for row in rows:
+        result = conn.execute(table.update().where(and_(*(table.c[key] == row[key] for key in keys))).values(
+            answered=table.c.answered + row['answered'],
+            correct=table.c.correct + row['correct'],
+        ))
+        if result.rowcount == 0:
+            conn.execute(table.insert(), row)
+
+
+def create_answer_buffer(app) -> AnswerBuffer:
+    """
+    create_answer_buffer(app)
+        builds the answers buffer from ANSWERS_BATCH_SIZE, ANSWERS_FLUSH_INTERVAL (seconds)
+        and ANSWERS_MAX_PENDING (default 50000)
+    """
+    return AnswerBuffer(
+        app,
+        batch_size=int(app.config.get('ANSWERS_BATCH_SIZE', 500)),
+        flush_interval=float(app.config.get('ANSWERS_FLUSH_INTERVAL', 2)),
+        max_pending=int(app.config.get('ANSWERS_MAX_PENDING', 50000)),
+    )
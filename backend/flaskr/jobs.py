@@ -0,0 +1,196 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from backend.flaskr.dedupe import index_batches, questions_to_index
+from backend.flaskr.events import bulk_writes_of
+from backend.models import db, Category, Job, Question
+
+jobs_cli = AppGroup('jobs', help='Background jobs tooling.')
+
+
+def _id_batches(questions, batch_size: int):
+    """
+    the ids of the questions query batch by batch, with keyset pagination so a batch never scans the rows
+    of the previous ones again, and a batch left as it was by the caller isn't read forever
+    """
+    last_id = 0
+    while True:
+        ids = [_id for _id, in questions.filter(Question.id > last_id).order_by(Question.id).limit(batch_size)]
+        if not ids:
+            break
+        yield ids
+        last_id = ids[-1]
+
+
+def delete_category(tenant: str, category_id: int, batch_size: int):
+    """
+    deletes the questions of the category chunk by chunk (their buckets cascade), then the category itself
+    """
+    questions = db.session.query(Question.id).filter_by(tenant=tenant, category_id=category_id)
+    total = questions.count()
+    done = 0
+    for ids in _id_batches(questions, batch_size):
+        Question.query.filter(Question.id.in_(ids)).delete(synchronize_session=False)
+        done += len(ids)
+        yield done, total
+    Category.query.filter_by(tenant=tenant, id=category_id).delete(synchronize_session=False)
+    yield done, total
+
+
+def recategorize(tenant: str, from_category_id: int, to_category_id: int, batch_size: int):
+    """
+    moves the questions of a category to another one chunk by chunk
+    """
+    questions = db.session.query(Question.id).filter_by(tenant=tenant, category_id=from_category_id)
+    total = questions.count()
+    done = 0
+    for ids in _id_batches(questions, batch_size):
+        Question.query.filter(Question.id.in_(ids)).update(
+            {'category_id': to_category_id}, synchronize_session=False
+        )
+        done += len(ids)
+        yield done, total
+
+
+def reindex_questions(tenant: str, batch_size: int, rebuild: bool = False):
+    """
+    fills the duplicates detection hashes and buckets of the tenant questions, like `flask dedupe index`
+    """
+    total = questions_to_index(rebuild, tenant).count()
+    done = 0
+    for indexed in index_batches(batch_size, rebuild, tenant):
+        done += indexed
+        yield done, total
+
+
+# kind: (handler, {param: (type, required)}), a handler is called with the job tenant and params,
+# it yields (done, total) after every chunk
+JOB_KINDS = {
+    'delete_category': (delete_category, {'category_id': (int, True)}),
+    'recategorize': (recategorize, {'from_category_id': (int, True), 'to_category_id': (int, True)}),
+    'reindex_questions': (reindex_questions, {'rebuild': (bool, False)}),
+}
+_CATEGORY_PARAMS = ('category_id', 'from_category_id', 'to_category_id')
+
+
+def validate_job(kind, params, tenant: str) -> str:
+    """
+    the message of what's wrong with the job of tenant, or an empty one
+    """
+    if kind not in JOB_KINDS:
+        return f"Kind should be one of {', '.join(JOB_KINDS)}."
+    if not isinstance(params, dict):
+        return "Params should be an object."
+
+    message = ""
+    spec = JOB_KINDS[kind][1]
+    for name, (_type, required) in spec.items():
+        if name not in params and required:
+            message += f"{name} is required. "
+        elif name in params and type(params[name]) is not _type:
+            message += f"{name} should be {_type.__name__}. "
+    for name in params:
+        if name not in spec:
+            message += f"{name} isn't a param of {kind}. "
+    for name in _CATEGORY_PARAMS:
+        if not isinstance(params.get(name), int):
+            continue
+        if not db.session.query(Category.query.filter_by(tenant=tenant, id=params[name]).exists()).scalar():
+            message += f"Category {params[name]} doesn't exist. "
+    if kind == 'recategorize' and params.get('from_category_id') == params.get('to_category_id'):
+        message += "from_category_id and to_category_id should be different. "
+    return message.strip()
+
+
+class JobQueue:
+    """
+    JobQueue
+        runs the jobs in a pool of `workers` threads, out of the requests. Every job is a row of jobs, claimed by one
+        worker, and runs in chunks of batch_size rows, one transaction each with its progress, so it never holds
+        locks for long and its status can be followed while it runs
+    """
+
+    def __init__(self, app, workers: int = 2, batch_size: int = 500):
+        self.app = app
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._futures = {}
+
+    def submit(self, kind: str, params: dict, tenant: str) -> Job:
+        """
+        saves a queued job of tenant and hands it to the workers
+        """
+        job = Job(kind, params, datetime.utcnow(), tenant)
+        db.session.add(job)
+        db.session.commit()
+        future = self._executor.submit(self.run, job.id)
+        self._futures[job.id] = future
+        # only the running jobs are kept, it's called right away when the job is already done
+        future.add_done_callback(lambda _, job_id=job.id: self._futures.pop(job_id, None))
+        return job
+
+    def wait(self, job_id: int, timeout: float = None):
+        """
+        waits for a job submitted here, it returns right away when the job is done
+        """
+        future = self._futures.get(job_id)
+        if future is not None:
+            future.result(timeout)
+
+    def run(self, job_id: int, resume: bool = False):
+        """
+        runs the job if it's still queued, or not finished with resume (after a crash),
+        the handlers can restart from scratch since what they did is committed
+        """
+        with self.app.app_context():
+            statuses = ['queued', 'running'] if resume else ['queued']
+            claimed = Job.query.filter(Job.id == job_id, Job.status.in_(statuses)).update(
+                {'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False
+            )
+            db.session.commit()
+            if not claimed:
+                return
+
+            job = Job.query.get(job_id)
+            handler = JOB_KINDS[job.kind][0]
+            try:
+                with bulk_writes_of(db.session, job.tenant):
+                    for done, total in handler(job.tenant, batch_size=self.batch_size, **json.loads(job.params)):
+                        job.progress, job.total = done, total
+                        db.session.commit()
+                job.status = 'done'
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.exception(f"Job {job_id} failed")
+                job.status = 'failed'
+                job.error = str(e)
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+
+
+def create_job_queue(app) -> JobQueue:
+    """
+    create_job_queue(app)
+        builds the jobs queue from JOBS_WORKERS (default 2) and JOBS_BATCH_SIZE (rows per chunk, default 500)
+    """
+    return JobQueue(
+        app,
+        workers=int(app.config.get('JOBS_WORKERS', 2)),
+        batch_size=int(app.config.get('JOBS_BATCH_SIZE', 500)),
+    )
+
+
+@jobs_cli.command('resume')
+def resume():
+    """Run the queued and interrupted jobs here, when no worker is running them anymore."""
+    queue: JobQueue = current_app.extensions['jobs']
+    ids = [_id for _id, in db.session.query(Job.id).filter(Job.status.in_(['queued', 'running'])).order_by(Job.id)]
+    for job_id in ids:
+        queue.run(job_id, resume=True)
+        job = Job.query.get(job_id)
+        click.echo(f"job {job_id} {job.kind}: {job.status} {job.progress}/{job.total}")
@@ -0,0 +1,194 @@
+import json
+import random
+import re
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, text
+from sqlalchemy.dialects import postgresql
+
+from backend.flaskr import queries
+from backend.flaskr.dedupe import exact_duplicates, similar_candidates
+from backend.models import db, DEFAULT_TENANT, Category, Job, Question
+
+perf_cli = AppGroup('perf', help='Performance tooling.')
+
+# below it a wrong estimate can't lead to a bad plan
+ESTIMATE_MIN_ROWS = 100
+# the filters a sequential scan is expected for, as PostgreSQL prints them: {reason: pattern}
+UNINDEXABLE_FILTERS = {
+    'substring search, ILIKE with a leading wildcard': r"~~\* '%",
+    'quiz previous questions, NOT IN': r"<> ALL \(",
+}
+
+
+def _paginated(name, query):
+    """the two statements flask-sqlalchemy paginate() issues for the first page: the items and the count"""
+    from backend.flaskr import QUESTIONS_PER_PAGE
+
+    return [
+        (f"{name} (items)", query.limit(QUESTIONS_PER_PAGE).offset(0)),
+        (f"{name} (count)", db.session.query(func.count()).select_from(query.order_by(None).subquery())),
+    ]
+
+
+def route_queries(tenant: str, category_id: int, question_id: int, job_id: int, term: str, question_text: str,
+                  previous_questions: list):
+    """
+    route_queries(...)
+        the queries issued by the routes in create_app for a request of tenant, from the builders the routes use
+    """
+    return [
+        ('GET /api/categories', queries.categories(tenant)),
+        ('GET /api/categories/stats', queries.category_stats(tenant)),
+        *_paginated('GET /api/questions', queries.questions(tenant)),
+        ('DELETE /api/questions/<id> (lookup)', queries.question(tenant, question_id)),
+        ('POST /api/questions (exact duplicates)', exact_duplicates(question_text, tenant)),
+        ('POST /api/questions (similar candidates)', similar_candidates(question_text, tenant)),
+        ('POST /api/questions (category exists)', queries.category_exists(tenant, category_id)),
+        *_paginated('POST /api/questions/search', queries.search_questions(tenant, term)),
+        ('GET /api/categories/<id>/questions (category)', queries.category(tenant, category_id)),
+        *_paginated('GET /api/categories/<id>/questions', queries.questions_in_category(tenant, category_id)),
+        ('POST /api/quizzes', queries.quiz_question(tenant, None, previous_questions)),
+        ('POST /api/quizzes (category)', queries.quiz_question(tenant, category_id, previous_questions)),
+        ('POST /api/quizzes/answers (question ids)', queries.question_ids(tenant, [question_id])),
+        *_paginated('GET /api/questions/accuracy', queries.questions_accuracy(tenant)),
+        ('GET /api/leaderboard', queries.leaderboard(tenant, 10)),
+        *_paginated('GET /api/jobs', queries.jobs(tenant)),
+        ('GET /api/jobs/<id>', queries.job(tenant, job_id)),
+    ]
+
+
+def _compile(query) -> str:
+    statement = getattr(query, 'statement', query)
+    # the named paramstyle doesn't escape the % of the literals, text() does it when executing
+    dialect = postgresql.dialect(paramstyle='named')
+    return str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+def _walk(plan: dict, limited: bool = False):
+    yield plan, limited
+    for child in plan.get('Plans', []):
+        # a merge join stops reading its inputs once either one is exhausted, like a Limit
+        yield from _walk(child, limited or plan['Node Type'] in ('Limit', 'Merge Join'))
+
+
+def audit_plan(plan: dict, table_sizes: dict, min_table_rows: int, threshold: float,
+               max_selectivity: float = 0.05) -> list:
+    """
+    audit_plan(plan, ...)
+        returns the problems found in an EXPLAIN (ANALYZE, FORMAT JSON) plan: sequential scans over tables bigger than
+        min_table_rows whose filter keeps at most max_selectivity of the rows it reads (an index would skip the others),
+        and nodes whose estimated rows are off by more than threshold times (when either is ESTIMATE_MIN_ROWS or more).
+        The filters of UNINDEXABLE_FILTERS are never flagged, a B-tree index can't serve them
+    """
+    problems = []
+    for node, limited in _walk(plan):
+        node_type = node['Node Type']
+        relation = node.get('Relation Name')
+        # a full scan without a filter (counting or listing a whole table) can't be helped by an index
+        if node_type == 'Seq Scan' and 'Filter' in node and table_sizes.get(relation, 0) >= min_table_rows:
+            # the rows read, not the table size, so a scan stopped early by a Limit is judged by what it read
+            read = node.get('Actual Rows', 0) + node.get('Rows Removed by Filter', 0)
+            selectivity = node.get('Actual Rows', 0) / read if read else 1.0
+            allowed = any(re.search(pattern, node['Filter']) for pattern in UNINDEXABLE_FILTERS.values())
+            if selectivity <= max_selectivity and not allowed:
+                problems.append(f"Seq Scan on {relation} ({table_sizes[relation]} rows) keeping {selectivity:.1%} "
+                                f"of the rows it reads, filtering by {node['Filter']}")
+
+        # the nodes under a Limit stop early, so their actual rows are expected to be lower than estimated
+        if limited or 'Actual Rows' not in node or node.get('Actual Loops', 1) == 0:
+            continue
+        estimated, actual = node['Plan Rows'], node['Actual Rows']
+        if max(estimated, actual) < ESTIMATE_MIN_ROWS:
+            continue
+        ratio = max(estimated, actual) / max(min(estimated, actual), 1)
+        if ratio > threshold:
+            problems.append(f"{node_type}{f' on {relation}' if relation else ''} estimated {estimated} rows, "
+                            f"got {actual} ({ratio:.0f}x)")
+    return problems
+
+
+def _seed(rows: int):
+    category_ids = [c.id for c in Category.query.filter_by(tenant=DEFAULT_TENANT)]
+    if not rows or not category_ids:
+        return
+    words = ['capital', 'river', 'painter', 'element', 'planet', 'century', 'team', 'author', 'title', 'movie']
+    db.session.execute(Question.__table__.insert(), [
+        {
+            'question': f"Synthetic question {i} about the {random.choice(words)}?",
+            'answer': f"Answer {i}",
+            'category_id': category_ids[i % len(category_ids)],
+            'difficulty': i % 5 + 1,
+        } for i in range(rows)
+    ])
+
+
+@perf_cli.command('explain')
+@click.option('--rows', default=10000, show_default=True,
+              help='Synthetic questions inserted before explaining, they are rolled back afterwards.')
+@click.option('--threshold', default=10.0, show_default=True,
+              help='Flag nodes whose estimated rows are off by more than this factor.')
+@click.option('--min-table-rows', default=1000, show_default=True,
+              help='Only flag sequential scans over tables with at least this many rows.')
+@click.option('--max-selectivity', default=0.05, show_default=True,
+              help='Only flag sequential scans keeping at most this share of the rows they read.')
+@click.option('--verbose', is_flag=True, help='Print the plans as well.')
+def explain(rows, threshold, min_table_rows, max_selectivity, verbose):
+    """Run EXPLAIN (ANALYZE, BUFFERS) for the queries of every route and flag bad plans."""
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException('EXPLAIN (ANALYZE, BUFFERS) is only supported on PostgreSQL.')
+
+    try:
+        _seed(rows)
+        # every table the routes read, with fresh statistics
+        db.session.execute(text('ANALYZE'))
+        table_sizes = {
+            name: int(count) for name, count in db.session.execute(text(
+                "SELECT relname, reltuples FROM pg_class "
+                "WHERE relkind IN ('r', 'm') AND relnamespace = CAST(current_schema() AS regnamespace)"
+            ))
+        }
+
+        category = Category.query.filter_by(tenant=DEFAULT_TENANT).first()
+        question = Question.query.filter_by(tenant=DEFAULT_TENANT).order_by(Question.id).first()
+        if category is None or question is None:
+            raise click.ClickException('The database has no data to explain, run the migrations first.')
+        previous_questions = [q.id for q in Question.query.with_entities(Question.id).limit(10)]
+        job = Job.query.filter_by(tenant=DEFAULT_TENANT).first()
+
+        problems_count = 0
+        for name, query in route_queries(
+            DEFAULT_TENANT, category.id, question.id, job.id if job else 0, 'title', question.question,
+            previous_questions,
+        ):
+            sql = _compile(query)
+            result = db.session.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}")).scalar()
+            plan = (json.loads(result) if isinstance(result, str) else result)[0]
+            problems = audit_plan(plan['Plan'], table_sizes, min_table_rows, threshold, max_selectivity)
+            problems_count += len(problems)
+
+            status = click.style('FLAG', fg='red') if problems else click.style(' OK ', fg='green')
+            click.echo(f"[{status}] {name} ({plan['Execution Time']:.2f} ms)")
+            for problem in problems:
+                click.echo(f"         - {problem}")
+            if verbose:
+                click.echo(sql)
+                click.echo(json.dumps(plan['Plan'], indent=2))
+    finally:
+        # the synthetic rows are never kept
+        db.session.rollback()
+
+    if problems_count:
+        raise click.ClickException(f"{problems_count} problem(s) found.")
+
+
+@perf_cli.command('profile-token')
+def profile_token():
+    """Print a signed X-Profile-Token header value, it needs PROFILING_SECRET."""
+    profiler = current_app.extensions['profiler']
+    if profiler.signer is None:
+        raise click.ClickException('PROFILING_SECRET is not set.')
+
+    click.echo(profiler.make_token())
@@ -0,0 +1,174 @@
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from itertools import count
+
+from flask import g, request, has_request_context
+from itsdangerous import TimestampSigner, BadSignature
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_HEADER = 'X-Profile-Token'
+
+
+class _Sampler(threading.Thread):
+    """
+    _Sampler
+        statistical profiler, it samples the call stack of one thread every interval seconds
+    """
+
+    def __init__(self, target_ident: int, interval: float):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        own_frames = (__file__, threading.__file__)
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                if code.co_filename not in own_frames:
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Profiler:
+    """
+    Profiler
+        profiles the requests carrying a valid signed X-Profile-Token header and a random sample_rate share
+        of the others, keeping the last max_profiles results in a ring buffer.
+        Requests that aren't profiled only pay for the header lookup and a random draw.
+    """
+
+    def __init__(self, secret: str = None, sample_rate: float = 0, interval: float = 0.005,
+                 max_profiles: int = 50, token_max_age: int = 3600):
+        self.signer = TimestampSigner(secret, salt='profiling') if secret else None
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.token_max_age = token_max_age
+        self.profiles = deque(maxlen=max_profiles)
+        self._ids = count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.signer is not None or self.sample_rate > 0
+
+    def make_token(self) -> str:
+        return self.signer.sign(b'profile').decode()
+
+    def is_authorized(self) -> bool:
+        token = request.headers.get(PROFILE_HEADER)
+        if not token or self.signer is None:
+            return False
+        try:
+            return self.signer.unsign(token, max_age=self.token_max_age) == b'profile'
+        except BadSignature:
+            return False
+
+    def start(self):
+        # the sub-requests of a batch are part of the batch profile
+        if request.path.startswith('/api/admin/') or 'profile' in g:
+            return
+        if not (self.sample_rate > random.random() or (PROFILE_HEADER in request.headers and self.is_authorized())):
+            return
+
+        sampler = _Sampler(threading.get_ident(), self.interval)
+        g.profile = {
+            'request': request._get_current_object(),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'started_at': datetime.utcnow().isoformat(),
+            'start': time.perf_counter(),
+            'sql': [],
+            'sampler': sampler,
+        }
+        sampler.start()
+
+    def stop(self, error=None):
+        # g belongs to the app context, shared with the sub-requests of a batch
+        if g.get('profile') is None or g.profile['request'] is not request._get_current_object():
+            return
+        profile = g.pop('profile')
+        del profile['request']
+        duration = time.perf_counter() - profile.pop('start')
+        sampler: _Sampler = profile.pop('sampler')
+        sampler.stop()
+
+        with self._lock:
+            self.profiles.append({
+                'id': next(self._ids),
+                **profile,
+                'duration_ms': round(duration * 1000, 3),
+                'samples': sum(sampler.stacks.values()),
+                'stacks': sampler.stacks,
+            })
+
+    def get(self, profile_id: int):
+        with self._lock:
+            return next((p for p in self.profiles if p['id'] == profile_id), None)
+
+    def summaries(self) -> list:
+        with self._lock:
+            return [
+                dict({k: v for k, v in p.items() if k not in ('stacks', 'sql')}, queries=len(p['sql']))
+                for p in reversed(self.profiles)
+            ]
+
+    @staticmethod
+    def folded(profile: dict) -> str:
+        """
+        the profile stacks in the folded format read by flamegraph.pl, speedscope and similar tools
+        """
+        return ''.join(f"{stack} {n}\n" for stack, n in profile['stacks'].most_common())
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile' in g:
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'profile' in g and conn.info.get('profile_query_start'):
+        start = conn.info['profile_query_start'].pop()
+        g.profile['sql'].append({
+            'statement': statement,
+            'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+        })
+
+
+def init_profiling(app) -> Profiler:
+    """
+    init_profiling(app)
+        sets the profiling hooks up from PROFILING_SECRET (for signed X-Profile-Token headers),
+        PROFILING_SAMPLE_RATE (0 to 1), PROFILING_INTERVAL (seconds between samples) and PROFILING_MAX_PROFILES,
+        nothing is registered when neither a secret nor a sample rate is set
+    """
+    profiler = Profiler(
+        secret=app.config.get('PROFILING_SECRET'),
+        sample_rate=float(app.config.get('PROFILING_SAMPLE_RATE', 0)),
+        interval=float(app.config.get('PROFILING_INTERVAL', 0.005)),
+        max_profiles=int(app.config.get('PROFILING_MAX_PROFILES', 50)),
+    )
+    if not profiler.enabled:
+        return profiler
+
+    app.before_request(profiler.start)
+    app.teardown_request(profiler.stop)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    return profiler
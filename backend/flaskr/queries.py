@@ -0,0 +1,73 @@
+"""
+the queries of the routes, built here so `flask perf explain` audits exactly what the routes run
+"""
+from sqlalchemy import and_, func
+
+from backend.models import db, Category, CategoryStats, Job, PlayerScore, Question, QuestionStats
+
+
+def categories(tenant: str):
+    return Category.query.filter_by(tenant=tenant)
+
+
+def category(tenant: str, category_id):
+    return categories(tenant).filter_by(id=category_id)
+
+
+def category_exists(tenant: str, category_id):
+    return db.session.query(category(tenant, category_id).exists())
+
+
+def category_stats(tenant: str):
+    return CategoryStats.query.filter_by(tenant=tenant).order_by(CategoryStats.category_id)
+
+
+def questions(tenant: str):
+    return Question.query.filter_by(tenant=tenant)
+
+
+def question(tenant: str, question_id):
+    return questions(tenant).filter_by(id=question_id)
+
+
+def questions_in_category(tenant: str, category_id):
+    return questions(tenant).filter_by(category_id=category_id)
+
+
+def question_ids(tenant: str, ids):
+    return db.session.query(Question.id).filter(Question.tenant == tenant, Question.id.in_(ids))
+
+
+def search_questions(tenant: str, term: str):
+    return questions(tenant).filter(Question.question.ilike(f"%{term}%"))
+
+
+def quiz_question(tenant: str, category_id, previous_questions: list):
+    """
+    a random question of the category (of any category without it) not in previous_questions
+    """
+    query = questions_in_category(tenant, category_id) if category_id else questions(tenant)
+    return query.filter(Question.id.notin_(previous_questions)).order_by(func.random()).limit(1)
+
+
+def questions_accuracy(tenant: str):
+    accuracy = QuestionStats.correct * 1.0 / QuestionStats.answered
+    return db.session.query(Question, QuestionStats).join(
+        QuestionStats, and_(QuestionStats.tenant == Question.tenant, QuestionStats.question_id == Question.id)
+    ).filter(
+        Question.tenant == tenant
+    ).order_by(accuracy, Question.id)
+
+
+def leaderboard(tenant: str, limit: int):
+    return PlayerScore.query.filter_by(tenant=tenant).order_by(
+        PlayerScore.correct.desc(), PlayerScore.player
+    ).limit(limit)
+
+
+def jobs(tenant: str):
+    return Job.query.filter_by(tenant=tenant).order_by(Job.id.desc())
+
+
+def job(tenant: str, job_id):
+    return Job.query.filter_by(tenant=tenant, id=job_id)
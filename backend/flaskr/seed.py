@@ -0,0 +1,338 @@
+import hashlib
+import json
+import random
+import time
+from contextlib import contextmanager, nullcontext
+from io import StringIO
+from itertools import islice
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Integer, text
+
+from backend.flaskr.stats import refresh_category_stats
+from backend.green import is_green
+from backend.models import db, DEFAULT_TENANT, Category, Question
+
+seed_cli = AppGroup('seed', help='Bulk seeding and database snapshots tooling.')
+
+SNAPSHOT_SCHEMA = 'seed_snapshot'
+# a load defers the indexes from this many rows, and when it's at least this ratio of the rows already in the table
+DEFER_MIN_ROWS = 10000
+DEFER_MIN_RATIO = 0.5
+_WORDS = ['capital', 'river', 'painter', 'element', 'planet', 'century', 'team', 'author', 'title', 'movie']
+
+
+def synthetic_questions(count: int, category_ids: list, seed: int = 0):
+    """
+    (question, answer, category_id, difficulty, question_hash) rows
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        bits = rng.getrandbits(40)
+        words = f"question {i} about the {_WORDS[bits % 10]} {bits >> 8:x}"
+        # already normalized (lowercase, without punctuation), so it's hashed without Question.hash_text
+        normalized = f"synthetic {words}"
+        yield (
+            f"Synthetic {words}?",
+            f"Answer {i}",
+            category_ids[i % len(category_ids)],
+            (bits >> 4) % 5 + 1,
+            hashlib.sha1(normalized.encode()).hexdigest(),
+        )
+
+
+def _csv_value(value) -> str:
+    if value is None:
+        return ''
+    value = str(value)
+    if not value or any(c in value for c in ',"\n\r'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def _csv_line(row) -> str:
+    """
+    the CSV line of row for COPY, where an empty unquoted value is NULL and a quoted one an empty string
+    """
+    if '' not in row:
+        line = ','.join(['' if value is None else str(value) for value in row])
+        # most rows don't need any quoting, they're joined without looking at every value
+        if line.count(',') == len(row) - 1 and '"' not in line and '\n' not in line and '\r' not in line:
+            return line + '\n'
+    return ','.join([_csv_value(value) for value in row]) + '\n'
+
+
+class _CsvStream:
+    """
+    file-like CSV of the rows read by COPY, rows are encoded as it reads so the database loads them meanwhile
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+        self._pending = ''
+
+    def read(self, size: int = -1) -> str:
+        chunks = [self._pending]
+        length = len(self._pending)
+        while size < 0 or length < size:
+            batch = list(islice(self.rows, 1000))
+            if not batch:
+                break
+            chunk = ''.join([_csv_line(row) for row in batch])
+            chunks.append(chunk)
+            length += len(chunk)
+            self.count += len(batch)
+        data = ''.join(chunks)
+        if 0 <= size < len(data):
+            data, self._pending = data[:size], data[size:]
+        else:
+            self._pending = ''
+        return data
+
+
+def bulk_load(table, columns: list, rows) -> int:
+    """
+    bulk_load(table, columns, rows)
+        appends the rows (tuples of the columns values) to table in the current transaction, with one streamed COPY
+        on PostgreSQL and multi-row INSERT statements elsewhere, rows can be a generator of any size
+    """
+    conn = db.session.connection()
+    # psycopg2 can't COPY with a wait callback (green mode)
+    if conn.dialect.name == 'postgresql' and not is_green():
+        stream = _CsvStream(rows)
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", stream, size=1 << 20
+            )
+        finally:
+            cursor.close()
+        return stream.count
+
+    rows = iter(rows)
+    # SQLite allows 999 variables per statement
+    per_statement = max(1, 999 // len(columns))
+    total = 0
+    while True:
+        chunk = [dict(zip(columns, row)) for row in islice(rows, per_statement)]
+        if not chunk:
+            return total
+        conn.execute(table.insert().values(chunk))
+        total += len(chunk)
+
+
+@contextmanager
+def deferred_indexes(table):
+    """
+    deferred_indexes(table)
+        drops the secondary indexes and the foreign keys of table during a bulk load and creates them again
+        afterwards, on PostgreSQL. Building an index once is much faster than updating it for every row,
+        and a foreign key is checked with one join instead of a trigger per row. The table is locked meanwhile
+    """
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+
+    params = {'table': table.name}
+    constraints = "SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass)"
+    indexes = db.session.execute(text(
+        f"SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table "
+        f"AND indexname NOT IN ({constraints})"
+    ), params).fetchall()
+    foreign_keys = db.session.execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"
+    ), params).fetchall()
+
+    for name, _ in foreign_keys:
+        db.session.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {name}"))
+    for name, _ in indexes:
+        db.session.execute(text(f"DROP INDEX {name}"))
+    yield
+    for _, definition in indexes:
+        db.session.execute(text(definition))
+    for name, definition in foreign_keys:
+        db.session.execute(text(f"ALTER TABLE {table.name} ADD CONSTRAINT {name} {definition}"))
+
+
+def large_load(table, rows: int, existing_rows: float = None) -> bool:
+    """
+    large_load(table, rows)
+        whether loading rows into table is faster with deferred_indexes. Building an index again sorts the whole table,
+        so it only pays off when the load is big, and big compared to the rows already there (estimated from the
+        statistics without existing_rows)
+    """
+    if rows < DEFER_MIN_ROWS or db.engine.dialect.name != 'postgresql':
+        return False
+    if existing_rows is None:
+        existing_rows = db.session.execute(text(
+            "SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"
+        ), {'table': table.name}).scalar()
+    # reltuples is -1 before the first ANALYZE
+    return rows >= max(existing_rows or 0, 0) * DEFER_MIN_RATIO
+
+
+def _tables():
+    return [t for t in db.metadata.sorted_tables if not t.info.get('is_view')]
+
+
+def _reset_sequences():
+    """
+    moves the id sequences after the loaded ids, the rows were inserted with their ids
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in _tables():
+        if 'id' in table.c and isinstance(table.c.id.type, Integer) and table.c.id.primary_key:
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), coalesce(max(id), 0) + 1, false) "
+                f"FROM {table.name}"
+            ))
+
+
+def _after_load():
+    _reset_sequences()
+    if db.engine.dialect.name == 'postgresql':
+        # fresh statistics, so the planner knows about the new rows right away
+        db.session.execute(text('ANALYZE questions'))
+        db.session.execute(text('ANALYZE categories'))
+    refresh_category_stats()
+
+
+def take_snapshot():
+    """
+    take_snapshot()
+        copies every table of the current database into the seed_snapshot schema, with the migrations revision
+    """
+    db.session.execute(text(f"DROP SCHEMA IF EXISTS {SNAPSHOT_SCHEMA} CASCADE"))
+    db.session.execute(text(f"CREATE SCHEMA {SNAPSHOT_SCHEMA}"))
+    for name in ['alembic_version'] + [t.name for t in _tables()]:
+        db.session.execute(text(f"CREATE TABLE {SNAPSHOT_SCHEMA}.{name} AS TABLE {name}"))
+        # restore_snapshot reads the sizes from the statistics
+        db.session.execute(text(f"ANALYZE {SNAPSHOT_SCHEMA}.{name}"))
+    db.session.commit()
+
+
+def restore_snapshot() -> bool:
+    """
+    restore_snapshot()
+        replaces the content of every table by the snapshot, in one transaction of a few milliseconds for a small
+        database. It's False without a snapshot of the current migrations revision, then nothing is changed
+    """
+    revisions = db.session.execute(text(
+        f"SELECT to_regclass('{SNAPSHOT_SCHEMA}.alembic_version'), to_regclass('alembic_version')"
+    )).first()
+    if None in revisions:
+        return False
+    snapshot_revision = db.session.execute(text(f"SELECT version_num FROM {SNAPSHOT_SCHEMA}.alembic_version")).scalar()
+    if snapshot_revision != db.session.execute(text('SELECT version_num FROM alembic_version')).scalar():
+        return False
+
+    tables = _tables()
+    sizes = dict(db.session.execute(text(
+        "SELECT relname, reltuples FROM pg_class WHERE relnamespace = CAST(:schema AS regnamespace)"
+    ), {'schema': SNAPSHOT_SCHEMA}).fetchall())
+    db.session.execute(text(f"TRUNCATE {', '.join(t.name for t in tables)} RESTART IDENTITY CASCADE"))
+    for table in tables:
+        columns = ', '.join(c.name for c in table.columns)
+        # the tables are empty after TRUNCATE
+        with deferred_indexes(table) if large_load(table, sizes.get(table.name, 0), 0) else nullcontext():
+            db.session.execute(text(
+                f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {SNAPSHOT_SCHEMA}.{table.name}"
+            ))
+    _reset_sequences()
+    refresh_category_stats()
+    return True
+
+
+def drop_snapshot():
+    db.session.execute(text(f"DROP SCHEMA IF EXISTS {SNAPSHOT_SCHEMA} CASCADE"))
+    db.session.commit()
+
+
+@seed_cli.command('generate')
+@click.option('--questions', default=100000, show_default=True, help='Synthetic questions to insert.')
+@click.option('--categories', default=0, show_default=True,
+              help='Synthetic categories to insert first, the questions go to every category.')
+@click.option('--random-seed', default=0, show_default=True, help='The same seed generates the same questions.')
+@click.option('--tenant', default=DEFAULT_TENANT, show_default=True, help='The tenant of the categories and questions.')
+def generate(questions, categories, random_seed, tenant):
+    """Bulk insert synthetic categories and questions."""
+    start = time.perf_counter()
+    if categories:
+        bulk_load(Category.__table__, ['tenant', 'type'], (
+            (tenant, f"Synthetic category {i}") for i in range(categories)
+        ))
+    category_ids = [_id for _id, in db.session.query(Category.id).filter_by(tenant=tenant)]
+    if not category_ids:
+        raise click.ClickException('There is no category, run the migrations first or pass --categories.')
+
+    with deferred_indexes(Question.__table__) if large_load(Question.__table__, questions) else nullcontext():
+        count = bulk_load(
+            Question.__table__, ['tenant', 'question', 'answer', 'category_id', 'difficulty', 'question_hash'],
+            ((tenant, *row) for row in synthetic_questions(questions, category_ids, random_seed)),
+        )
+    _after_load()
+    db.session.commit()
+
+    elapsed = time.perf_counter() - start
+    click.echo(f"{count} questions inserted in {elapsed:.2f}s ({count / elapsed:.0f} rows/s)")
+    click.echo("Run `flask dedupe index` to detect their duplicates.")
+
+
+@seed_cli.command('fixture')
+@click.argument('path', type=click.File())
+@click.option('--tenant', default=DEFAULT_TENANT, show_default=True, help='The tenant of the categories and questions.')
+def fixture(path, tenant):
+    """Bulk insert the categories and questions of a JSON fixture.
+
+    It has a list of categories with their id and type, and a list of questions formatted like the API does.
+    The categories get new ids, the questions of a fixture category are moved to its new id, the other questions
+    have to be in an existing category of the tenant. It bootstraps a new tenant as well.
+    """
+    data = json.load(path)
+    # the ids are shared by every tenant, the fixture ones are only valid within the fixture
+    new_ids = {}
+    for c in data.get('categories', []):
+        result = db.session.execute(Category.__table__.insert().values(tenant=tenant, type=c['type']))
+        new_ids[c['id']] = result.inserted_primary_key[0]
+    existing = {_id for _id, in db.session.query(Category.id).filter_by(tenant=tenant)}
+    unknown = {q['category'] for q in data.get('questions', [])} - set(new_ids) - existing
+    if unknown:
+        raise click.ClickException(f"Categories {', '.join(map(str, sorted(unknown)))} don't exist in {tenant}.")
+
+    columns = ['tenant', 'question', 'answer', 'category_id', 'difficulty', 'question_hash']
+    large = large_load(Question.__table__, len(data.get('questions', [])))
+    with deferred_indexes(Question.__table__) if large else nullcontext():
+        questions = bulk_load(Question.__table__, columns, (
+            (tenant, q['question'], q['answer'], new_ids.get(q['category'], q['category']), q['difficulty'],
+             Question.hash_text(q['question']))
+            for q in data.get('questions', [])
+        ))
+    _after_load()
+    db.session.commit()
+
+    click.echo(f"{len(new_ids)} categories and {questions} questions inserted")
+    click.echo("Run `flask dedupe index` to detect their duplicates.")
+
+
+@seed_cli.command('snapshot')
+def snapshot():
+    """Save the content of the database, to restore it with `flask seed restore` (PostgreSQL only)."""
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException('Snapshots are only supported on PostgreSQL.')
+    take_snapshot()
+    click.echo(f"Snapshot saved in the {SNAPSHOT_SCHEMA} schema")
+
+
+@seed_cli.command('restore')
+def restore():
+    """Restore the content of the database saved by `flask seed snapshot`."""
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException('Snapshots are only supported on PostgreSQL.')
+    if not restore_snapshot():
+        raise click.ClickException('There is no snapshot of the current migrations revision.')
+    db.session.commit()
+    click.echo('Snapshot restored')
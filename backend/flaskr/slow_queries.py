@@ -0,0 +1,188 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\?|:\w+")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """
+    the statement without its literals and placeholders, so every run of the same query shares one fingerprint
+    """
+    normalized = _STRING_LITERAL.sub('?', statement)
+    normalized = _NUMBER_LITERAL.sub('?', normalized)
+    normalized = _PLACEHOLDER.sub('?', normalized)
+    normalized = _IN_LIST.sub('IN (...)', normalized)
+    return _SPACES.sub(' ', normalized).strip()
+
+
+def redact(parameters):
+    """
+    keeps the numbers, booleans and nulls of the parameters and hides every string (search terms, answers, names)
+    """
+    if isinstance(parameters, dict):
+        return {k: redact(v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact(v) for v in parameters]
+    if parameters is None or isinstance(parameters, (bool, int, float)):
+        return parameters
+    return '***'
+
+
+class SlowQueryLog:
+    """
+    SlowQueryLog
+        records the statements slower than threshold_ms with their redacted parameters and originating route,
+        keeps the last max_recent of them and aggregates them per fingerprint (at most max_fingerprints).
+        On PostgreSQL the plan of every new slow SELECT fingerprint is captured in a background thread.
+    """
+
+    def __init__(self, threshold_ms: float = 500, max_recent: int = 100, max_fingerprints: int = 500,
+                 explain: bool = True, explain_every: float = 300):
+        self.threshold_ms = threshold_ms
+        self.recent = deque(maxlen=max_recent)
+        self.fingerprints = {}
+        self.max_fingerprints = max_fingerprints
+        self.explain = explain
+        self.explain_every = explain_every
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def record(self, conn, statement: str, parameters, duration_ms: float, executemany: bool):
+        route = None
+        if has_request_context() and request.url_rule is not None:
+            route = f"{request.method} {request.url_rule.rule}"
+        key = hashlib.sha1(fingerprint(statement).encode()).hexdigest()[:16]
+        entry = {
+            'fingerprint': key,
+            'statement': statement,
+            'parameters': redact(parameters) if not executemany else f"{len(parameters)} rows",
+            'duration_ms': round(duration_ms, 3),
+            'route': route,
+            'at': datetime.utcnow().isoformat(),
+        }
+        current_app.logger.warning('Slow query (%.1f ms) from %s: %s', duration_ms, route, statement)
+
+        with self._lock:
+            self.recent.append(entry)
+            stats = self.fingerprints.get(key)
+            if stats is None:
+                if len(self.fingerprints) >= self.max_fingerprints:
+                    # make room by forgetting the fingerprint with the least total time
+                    del self.fingerprints[min(self.fingerprints, key=lambda k: self.fingerprints[k]['total_ms'])]
+                stats = self.fingerprints[key] = {
+                    'fingerprint': key,
+                    'query': fingerprint(statement),
+                    'count': 0,
+                    'total_ms': 0,
+                    'max_ms': 0,
+                    'routes': [],
+                    'plan': None,
+                    'plan_at': None,
+                    '_explained_at': 0,
+                }
+            stats['count'] += 1
+            stats['total_ms'] = round(stats['total_ms'] + duration_ms, 3)
+            stats['max_ms'] = max(stats['max_ms'], entry['duration_ms'])
+            stats['last_at'] = entry['at']
+            if route and route not in stats['routes']:
+                stats['routes'].append(route)
+
+            should_explain = (
+                self.explain and not executemany and conn.dialect.name == 'postgresql'
+                and statement.lstrip()[:6].upper() == 'SELECT'
+                and time.monotonic() - stats['_explained_at'] > self.explain_every
+            )
+            if should_explain:
+                stats['_explained_at'] = time.monotonic()
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-explain')
+                self._executor.submit(self._capture_plan, conn.engine, key, statement, parameters)
+
+    def _capture_plan(self, engine, key: str, statement: str, parameters):
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+            plan = cursor.fetchone()[0]
+            raw.rollback()
+        except Exception as e:  # the plan is only a nice to have, it never breaks anything
+            plan = {'error': str(e)}
+        finally:
+            raw.close()
+
+        with self._lock:
+            stats = self.fingerprints.get(key)
+            if stats is not None:
+                stats['plan'] = json.loads(plan) if isinstance(plan, str) else plan
+                stats['plan_at'] = datetime.utcnow().isoformat()
+
+    def summary(self) -> dict:
+        with self._lock:
+            fingerprints = sorted(self.fingerprints.values(), key=lambda s: s['total_ms'], reverse=True)
+            return {
+                'threshold_ms': self.threshold_ms,
+                'fingerprints': [
+                    dict({k: v for k, v in s.items() if not k.startswith('_')},
+                         avg_ms=round(s['total_ms'] / s['count'], 3))
+                    for s in fingerprints
+                ],
+                'recent': list(reversed(self.recent)),
+            }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('slow_query_start')
+    if not starts:
+        return
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+    if not has_app_context():
+        return
+    log = current_app.extensions.get('slow_queries')
+    if log is not None and duration_ms >= log.threshold_ms:
+        log.record(conn, statement, parameters, duration_ms, executemany)
+
+
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute
+    starts = context.connection.info.get('slow_query_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def init_slow_queries(app):
+    """
+    init_slow_queries(app)
+        sets the slow query log up from SLOW_QUERY_THRESHOLD_MS (default 500) and SLOW_QUERY_EXPLAIN (default True),
+        it's turned off with SLOW_QUERY_LOG=False
+    """
+    if not app.config.get('SLOW_QUERY_LOG', True):
+        return None
+
+    log = SlowQueryLog(
+        threshold_ms=float(app.config.get('SLOW_QUERY_THRESHOLD_MS', 500)),
+        explain=bool(app.config.get('SLOW_QUERY_EXPLAIN', True)),
+    )
+    app.extensions['slow_queries'] = log
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    return log
@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Set
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from backend.models import DEFAULT_TENANT
+
+snapshots_cli = AppGroup('snapshots', help='Static JSON snapshots tooling.')
+
+
+class SnapshotPublisher:
+    """
+    SnapshotPublisher
+        renders the responses of the default tenant shared by every user to static JSON files a CDN or nginx can serve
+        directly:
+            api/categories/index.json                          GET /api/categories
+            api/questions/page-<n>.json                        GET /api/questions?page=<n>
+            api/categories/<id>/questions/page-<n>.json        GET /api/categories/<id>/questions?page=<n>
+        for the first `pages` pages. After a write only the questions pages and the pages of the changed categories
+        are rendered again, in a background thread after `debounce` seconds so a burst of writes is published once.
+        Files are replaced atomically and only when their content changed.
+    """
+
+    def __init__(self, app, directory, pages: int = 3, debounce: float = 0.5):
+        self.app = app
+        self.directory = Path(directory)
+        self.pages = pages
+        self.debounce = debounce
+        self._dirty = set()
+        self._everything = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def invalidate(self, category_ids: Set[int], tenants: Set[str] = None):
+        """
+        marks the files affected by a write to the questions of category_ids, every file when it's empty.
+        Only the default tenant is published, the writes of the other tenants are ignored
+        """
+        if tenants and DEFAULT_TENANT not in tenants:
+            return
+        with self._lock:
+            if category_ids:
+                self._dirty.update(category_ids)
+            else:
+                self._everything = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='snapshot-publisher', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # let the burst of writes end before rendering
+            time.sleep(self.debounce)
+            self._wakeup.clear()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                everything, self._everything = self._everything, False
+            try:
+                if everything:
+                    self.publish_all()
+                else:
+                    self.publish(dirty)
+            except Exception:
+                self.app.logger.exception('Publishing the snapshots failed')
+
+    def publish_all(self) -> int:
+        """
+        renders every snapshot and drops the ones of the deleted categories, returns the rendered files count
+        """
+        categories = self._render('/api/categories')
+        category_ids = set(int(c) for c in (categories or {}).get('categories', {}))
+        published = {int(p.name) for p in Path(self.directory, 'api', 'categories').glob('*') if p.name.isdigit()}
+        return self.publish(category_ids | published)
+
+    def publish(self, category_ids: Set[int]) -> int:
+        """
+        renders the categories list, the questions pages and the pages of category_ids
+        """
+        if self._publish('/api/categories', Path('api', 'categories', 'index.json')) != 200:
+            raise RuntimeError('GET /api/categories failed')
+        written = 1
+        written += self._publish_pages('/api/questions', Path('api', 'questions'))
+        for category_id in sorted(category_ids):
+            written += self._publish_pages(
+                f"/api/categories/{category_id}/questions", Path('api', 'categories', str(category_id), 'questions')
+            )
+        return written
+
+    def _publish_pages(self, url: str, path: Path) -> int:
+        for page in range(1, self.pages + 1):
+            status = self._publish(f"{url}?page={page}", Path(path, f"page-{page}.json"))
+            if status == 200:
+                continue
+            if status == 404 and page == 1:
+                # the category itself doesn't exist anymore
+                shutil.rmtree(Path(self.directory, path.parent), ignore_errors=True)
+            elif status == 404:
+                # the pages after the last one aren't valid anymore
+                for stale in range(page, self.pages + 1):
+                    _unlink(Path(self.directory, path, f"page-{stale}.json"))
+            else:
+                raise RuntimeError(f"GET {url}?page={page} responded with {status}")
+            return page - 1
+        return self.pages
+
+    def _render(self, url: str):
+        response = self.app.test_client().get(url)
+        return response.get_json() if response.status_code == 200 else None
+
+    def _publish(self, url: str, path: Path) -> int:
+        response = self.app.test_client().get(url)
+        if response.status_code == 200:
+            _write_atomically(Path(self.directory, path), response.get_data())
+        return response.status_code
+
+
+def _unlink(path: Path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _write_atomically(path: Path, data: bytes):
+    """
+    readers see either the old file or the new one, never a partial one
+    """
+    try:
+        if path.read_bytes() == data:
+            return
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError:
+        _unlink(Path(tmp_path))
+        raise
+
+
+def create_snapshot_publisher(app):
+    """
+    create_snapshot_publisher(app)
+        builds the publisher from SNAPSHOT_DIR, SNAPSHOT_PAGES (default 3) and SNAPSHOT_DEBOUNCE (seconds, default 0.5),
+        there's no publisher when SNAPSHOT_DIR isn't set
+    """
+    directory = app.config.get('SNAPSHOT_DIR')
+    if not directory:
+        return None
+
+    return SnapshotPublisher(
+        app, directory,
+        pages=int(app.config.get('SNAPSHOT_PAGES', 3)),
+        debounce=float(app.config.get('SNAPSHOT_DEBOUNCE', 0.5)),
+    )
+
+
+@snapshots_cli.command('publish')
+def publish():
+    """Render every snapshot into SNAPSHOT_DIR."""
+    publisher = current_app.extensions.get('snapshots')
+    if publisher is None:
+        raise click.ClickException('SNAPSHOT_DIR is not set.')
+
+    click.echo(f"{publisher.publish_all()} file(s) published to {publisher.directory}")
@@ -0,0 +1,111 @@
+import threading
+import time
+from typing import Set
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Float, case, cast, func, select, text
+
+from backend.models import db, Category, CategoryStats, Question
+
+stats_cli = AppGroup('stats', help='Category stats tooling.')
+
+
+def _stats_select(category_ids: Set[int] = None):
+    """
+    the category_stats rows of category_ids, of every category when it's empty
+    """
+    questions, categories = Question.__table__, Category.__table__
+    query = select([
+        categories.c.id,
+        categories.c.tenant,
+        categories.c.type,
+        func.count(questions.c.id),
+        cast(func.avg(questions.c.difficulty), Float),
+        *[func.sum(case([(questions.c.difficulty == d, 1)], else_=0)) for d in range(1, 6)],
+    ]).select_from(
+        categories.outerjoin(questions, questions.c.category_id == categories.c.id)
+    ).group_by(categories.c.id, categories.c.tenant, categories.c.type)
+    if category_ids:
+        query = query.where(categories.c.id.in_(category_ids))
+    return query
+
+
+def refresh_category_stats(category_ids: Set[int] = None):
+    """
+    refresh_category_stats()
+        recomputes category_stats, on PostgreSQL the whole materialized view is refreshed concurrently so reads
+        aren't blocked, elsewhere only the rows of category_ids (every row when it's empty) are replaced
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('REFRESH MATERIALIZED VIEW CONCURRENTLY category_stats'))
+    else:
+        table = CategoryStats.__table__
+        delete = table.delete()
+        if category_ids:
+            delete = delete.where(table.c.category_id.in_(category_ids))
+        db.session.execute(delete)
+        db.session.execute(table.insert().from_select([c.name for c in table.columns], _stats_select(category_ids)))
+    db.session.commit()
+
+
+class CategoryStatsRefresher:
+    """
+    CategoryStatsRefresher
+        refreshes category_stats in a background thread `debounce` seconds after a write to questions,
+        so a burst of writes is aggregated once and the requests never wait for it
+    """
+
+    def __init__(self, app, debounce: float = 1.0):
+        self.app = app
+        self.debounce = debounce
+        self._dirty = set()
+        self._everything = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def invalidate(self, category_ids: Set[int], tenants: Set[str] = None):
+        """
+        marks the stats of category_ids as stale, every category when it's empty,
+        the categories ids are unique across the tenants
+        """
+        with self._lock:
+            if category_ids:
+                self._dirty.update(category_ids)
+            else:
+                self._everything = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='category-stats-refresher', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # let the burst of writes end before aggregating
+            time.sleep(self.debounce)
+            self._wakeup.clear()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                everything, self._everything = self._everything, False
+            try:
+                with self.app.app_context():
+                    refresh_category_stats(None if everything else dirty)
+            except Exception:
+                self.app.logger.exception('Refreshing the category stats failed')
+
+
+def create_category_stats_refresher(app):
+    """
+    create_category_stats_refresher(app)
+        builds the refresher from CATEGORY_STATS_DEBOUNCE (seconds, default 1)
+    """
+    return CategoryStatsRefresher(app, debounce=float(app.config.get('CATEGORY_STATS_DEBOUNCE', 1.0)))
+
+
+@stats_cli.command('refresh')
+def refresh():
+    """Recompute the stats of every category."""
+    refresh_category_stats()
+    click.echo(f"{CategoryStats.query.count()} category stats refreshed")
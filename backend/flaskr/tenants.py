@@ -0,0 +1,88 @@
+import re
+import threading
+import time
+
+from flask import g, request, has_request_context
+from werkzeug.exceptions import NotFound
+
+from backend.models import db, DEFAULT_TENANT, Category
+
+TENANT_HEADER = 'X-Tenant'
+# usable as a subdomain and as a directory name
+_SLUG = re.compile(r'^[a-z0-9][a-z0-9-]{0,62}$')
+
+
+def current_tenant() -> str:
+    """
+    the tenant of the current request, the default one out of the requests (CLI commands, background threads)
+    """
+    if has_request_context() and 'tenant' in g:
+        return g.tenant
+    return DEFAULT_TENANT
+
+
+def resolve_tenant(domain: str = None) -> str:
+    """
+    resolve_tenant(domain)
+        the tenant of the request from its subdomain of domain, or from its X-Tenant header, the default tenant
+        without either. It isn't validated, and it's None when the header names another tenant than the subdomain
+    """
+    header = (request.headers.get(TENANT_HEADER) or '').strip().lower() or None
+
+    if domain:
+        host = request.host.split(':')[0].lower()
+        if host.endswith(f".{domain}"):
+            subdomain = host[:-len(domain) - 1]
+            # a header can't reach another tenant than the one of the host
+            return subdomain if header in (None, subdomain) else None
+    return header or DEFAULT_TENANT
+
+
+class KnownTenants:
+    """
+    KnownTenants(allowed, refresh_interval)
+        the tenants worth their own cache partition: the default one, the allowed ones and the ones having categories.
+        The tenants of the categories are read again at most every refresh_interval seconds, so a request of an
+        unknown tenant doesn't query the database every time
+    """
+
+    def __init__(self, allowed: set = None, refresh_interval: float = 60):
+        self.allowed = set(allowed or ())
+        self.refresh_interval = refresh_interval
+        self._tenants = set()
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, tenant: str) -> bool:
+        if tenant == DEFAULT_TENANT or tenant in self.allowed:
+            return True
+        now = time.monotonic()
+        if self._refreshed_at is None or now - self._refreshed_at >= self.refresh_interval:
+            with self._lock:
+                if self._refreshed_at is None or now - self._refreshed_at >= self.refresh_interval:
+                    self._tenants = {t for t, in db.session.query(Category.tenant).distinct()}
+                    self._refreshed_at = now
+        return tenant in self._tenants
+
+
+def init_tenants(app) -> KnownTenants:
+    """
+    init_tenants(app)
+        resolves the tenant of every request into g.tenant, with TENANT_DOMAIN as the parent domain of the tenants
+        subdomains. When TENANTS (comma separated) is set only those tenants and the default one exist,
+        the requests of any other tenant are 404 like the requests of an invalid tenant or of a header contradicting
+        the subdomain. Returns the known tenants, refreshed every TENANTS_REFRESH_INTERVAL seconds (default 60)
+    """
+    domain = (app.config.get('TENANT_DOMAIN') or '').lower() or None
+    allowed = {t.strip() for t in (app.config.get('TENANTS') or '').split(',') if t.strip()}
+
+    @app.before_request
+    def set_tenant():
+        tenant = resolve_tenant(domain)
+        if tenant is None or not _SLUG.match(tenant):
+            raise NotFound
+        if allowed and tenant != DEFAULT_TENANT and tenant not in allowed:
+            raise NotFound
+        g.tenant = tenant
+
+    return KnownTenants(allowed, float(app.config.get('TENANTS_REFRESH_INTERVAL', 60)))
@@ -0,0 +1,109 @@
+import threading
+import time
+
+from sqlalchemy import text
+
+from backend.models import db, Category
+
+# the read requests run once by the warm-up, so their imports, queries and caches are ready for the first users
+WARMUP_REQUESTS = [
+    ('GET', '/api/categories', None),
+    ('GET', '/api/questions', None),
+    ('GET', '/api/categories/{category_id}/questions', None),
+    ('GET', '/api/categories/stats', None),
+    ('POST', '/api/questions/search', {'q': ''}),
+    ('POST', '/api/quizzes', {'previous_questions': []}),
+    ('GET', '/api/questions/accuracy', None),
+    ('GET', '/api/leaderboard', None),
+]
+
+
+class Warmup:
+    """
+    Warmup
+        gets a worker ready for traffic in a background thread: it opens the pool connections, runs the read routes once
+        (which also fills the search cache) and only then the worker is ready. A failed warm-up is retried
+        when the readiness is checked again
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.duration_ms = None
+        self.error = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self):
+        with self._lock:
+            if self.ready or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self.run, name='warmup', daemon=True)
+            self._thread.start()
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                self._open_connections()
+                category = Category.query.order_by(Category.id).first()
+                db.session.remove()
+            client = self.app.test_client()
+            for method, path, body in WARMUP_REQUESTS:
+                if '{category_id}' in path and category is None:
+                    continue
+                path = path.format(category_id=category.id if category else None)
+                response = client.open(path, method=method, json=body)
+                if response.status_code >= 500:
+                    raise RuntimeError(f"{method} {path} responded with {response.status_code}")
+        except Exception as e:
+            self.error = str(e)
+            self.app.logger.exception('Warming up failed')
+            return
+
+        self.error = None
+        self.duration_ms = round((time.perf_counter() - start) * 1000, 3)
+        self._ready.set()
+
+    @staticmethod
+    def _open_connections():
+        """
+        connects the pool_size connections of the pool at once, they're kept open by the pool afterwards
+        """
+        size = db.engine.pool.size() if hasattr(db.engine.pool, 'size') else 1
+        connections = []
+        try:
+            for _ in range(size):
+                connection = db.engine.connect()
+                connections.append(connection)
+                connection.execute(text('SELECT 1'))
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def summary(self) -> dict:
+        # the error itself is only logged, the probes don't need the database details
+        return {
+            'ready': self.ready,
+            'warmup_ms': self.duration_ms,
+            'failed': self.error is not None,
+        }
+
+
+def create_warmup(app) -> Warmup:
+    """
+    create_warmup(app)
+        builds the warm-up, started by the first request (usually the readiness probe) unless WARMUP is False,
+        so the CLI commands never run it. The readiness probe starts it anyway
+    """
+    warmup = Warmup(app)
+    if app.config.get('WARMUP', True):
+        app.before_first_request(warmup.start)
+    return warmup
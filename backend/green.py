@@ -0,0 +1,37 @@
+def gevent_wait_callback(conn, timeout=None):
+    """
+    psycopg2 wait callback yielding to the gevent hub while the connection waits on the network,
+    so the other greenlets keep running during a query
+    """
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state}")
+
+
+def patch_psycopg():
+    """
+    makes psycopg2 cooperative, call it right after gevent monkey patching and before any connection is opened
+    """
+    from psycopg2 import extensions
+
+    extensions.set_wait_callback(gevent_wait_callback)
+
+
+def is_green() -> bool:
+    """
+    whether psycopg2 is cooperative, it can't COPY then
+    """
+    # psycopg2 is only imported for PostgreSQL, like SQLAlchemy does
+    from psycopg2 import extensions
+
+    return extensions.get_wait_callback() is not None
@@ -72,6 +72,10 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # the tables mapped over views (like category_stats) are created by their migration, not autogenerated
+    def include_object(object, name, type_, reflected, compare_to):
+        return not (type_ == 'table' and object.info.get('is_view'))
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix='sqlalchemy.',
@@ -83,6 +87,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,62 @@
+"""Add the category stats, a materialized view on PostgreSQL or a table elsewhere
+
+Revision ID: 3f8d6b1c0a72
+Revises: e2a9c5f7184b
+Create Date: 2026-10-19 14:22:40.316845
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8d6b1c0a72'
+down_revision = 'e2a9c5f7184b'
+branch_labels = None
+depends_on = None
+
+# the categories without questions are kept, with 0 questions and no average difficulty
+STATS_QUERY = """
+SELECT c.id AS category_id,
+       c.type AS type,
+       count(q.id) AS questions,
+       CAST(avg(q.difficulty) AS FLOAT) AS average_difficulty,
+       sum(CASE WHEN q.difficulty = 1 THEN 1 ELSE 0 END) AS difficulty_1,
+       sum(CASE WHEN q.difficulty = 2 THEN 1 ELSE 0 END) AS difficulty_2,
+       sum(CASE WHEN q.difficulty = 3 THEN 1 ELSE 0 END) AS difficulty_3,
+       sum(CASE WHEN q.difficulty = 4 THEN 1 ELSE 0 END) AS difficulty_4,
+       sum(CASE WHEN q.difficulty = 5 THEN 1 ELSE 0 END) AS difficulty_5
+FROM categories c
+LEFT JOIN questions q ON q.category_id = c.id
+GROUP BY c.id, c.type
+"""
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(f"CREATE MATERIALIZED VIEW category_stats AS {STATS_QUERY}")
+        # REFRESH MATERIALIZED VIEW CONCURRENTLY needs a unique index
+        op.create_index('ix_category_stats_category_id', 'category_stats', ['category_id'], unique=True)
+        return
+
+    op.create_table(
+        'category_stats',
+        sa.Column('category_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('type', sa.String(), nullable=True),
+        sa.Column('questions', sa.Integer(), nullable=False),
+        sa.Column('average_difficulty', sa.Float(), nullable=True),
+        sa.Column('difficulty_1', sa.Integer(), nullable=False),
+        sa.Column('difficulty_2', sa.Integer(), nullable=False),
+        sa.Column('difficulty_3', sa.Integer(), nullable=False),
+        sa.Column('difficulty_4', sa.Integer(), nullable=False),
+        sa.Column('difficulty_5', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('category_id')
+    )
+    op.execute(f"INSERT INTO category_stats {STATS_QUERY}")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP MATERIALIZED VIEW category_stats")
+    else:
+        op.drop_table('category_stats')
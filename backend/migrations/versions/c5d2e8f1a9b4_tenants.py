@@ -0,0 +1,160 @@
+"""Scope the question banks by tenant, the existing rows belong to the default tenant
+
+Revision ID: c5d2e8f1a9b4
+Revises: 9a4c7e5b2d18
+Create Date: 2026-10-19 16:58:31.209714
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d2e8f1a9b4'
+down_revision = '9a4c7e5b2d18'
+branch_labels = None
+depends_on = None
+
+TENANT_TABLES = ['categories', 'questions', 'answer_events', 'jobs']
+
+# like the 3f8d6b1c0a72 one, with the tenant of every category
+STATS_QUERY = """
+SELECT c.id AS category_id,
+       c.tenant AS tenant,
+       c.type AS type,
+       count(q.id) AS questions,
+       CAST(avg(q.difficulty) AS FLOAT) AS average_difficulty,
+       sum(CASE WHEN q.difficulty = 1 THEN 1 ELSE 0 END) AS difficulty_1,
+       sum(CASE WHEN q.difficulty = 2 THEN 1 ELSE 0 END) AS difficulty_2,
+       sum(CASE WHEN q.difficulty = 3 THEN 1 ELSE 0 END) AS difficulty_3,
+       sum(CASE WHEN q.difficulty = 4 THEN 1 ELSE 0 END) AS difficulty_4,
+       sum(CASE WHEN q.difficulty = 5 THEN 1 ELSE 0 END) AS difficulty_5
+FROM categories c
+LEFT JOIN questions q ON q.category_id = c.id
+GROUP BY c.id, c.tenant, c.type
+"""
+PREVIOUS_STATS_QUERY = """
+SELECT c.id AS category_id,
+       c.type AS type,
+       count(q.id) AS questions,
+       CAST(avg(q.difficulty) AS FLOAT) AS average_difficulty,
+       sum(CASE WHEN q.difficulty = 1 THEN 1 ELSE 0 END) AS difficulty_1,
+       sum(CASE WHEN q.difficulty = 2 THEN 1 ELSE 0 END) AS difficulty_2,
+       sum(CASE WHEN q.difficulty = 3 THEN 1 ELSE 0 END) AS difficulty_3,
+       sum(CASE WHEN q.difficulty = 4 THEN 1 ELSE 0 END) AS difficulty_4,
+       sum(CASE WHEN q.difficulty = 5 THEN 1 ELSE 0 END) AS difficulty_5
+FROM categories c
+LEFT JOIN questions q ON q.category_id = c.id
+GROUP BY c.id, c.type
+"""
+
+
+def _tenant_column():
+    return sa.Column('tenant', sa.String(length=63), server_default='default', nullable=False)
+
+
+def _create_category_stats(query: str, with_tenant: bool):
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(f"CREATE MATERIALIZED VIEW category_stats AS {query}")
+        # REFRESH MATERIALIZED VIEW CONCURRENTLY needs a unique index
+        op.create_index('ix_category_stats_category_id', 'category_stats', ['category_id'], unique=True)
+        if with_tenant:
+            op.create_index('ix_category_stats_tenant', 'category_stats', ['tenant'], unique=False)
+        return
+
+    op.create_table(
+        'category_stats',
+        sa.Column('category_id', sa.Integer(), autoincrement=False, nullable=False),
+        *([sa.Column('tenant', sa.String(length=63), nullable=False)] if with_tenant else []),
+        sa.Column('type', sa.String(), nullable=True),
+        sa.Column('questions', sa.Integer(), nullable=False),
+        sa.Column('average_difficulty', sa.Float(), nullable=True),
+        sa.Column('difficulty_1', sa.Integer(), nullable=False),
+        sa.Column('difficulty_2', sa.Integer(), nullable=False),
+        sa.Column('difficulty_3', sa.Integer(), nullable=False),
+        sa.Column('difficulty_4', sa.Integer(), nullable=False),
+        sa.Column('difficulty_5', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('category_id')
+    )
+    op.execute(f"INSERT INTO category_stats {query}")
+
+
+def _drop_category_stats():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP MATERIALIZED VIEW category_stats")
+    else:
+        op.drop_table('category_stats')
+
+
+def upgrade():
+    # the view reads categories, it has to be dropped before they're altered (the batch mode recreates tables)
+    _drop_category_stats()
+
+    for table in TENANT_TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(_tenant_column())
+    op.create_index('ix_categories_tenant_id', 'categories', ['tenant', 'id'], unique=False)
+    op.create_index('ix_questions_tenant_category_id', 'questions', ['tenant', 'category_id'], unique=False)
+    op.create_index('ix_questions_tenant_question_hash', 'questions', ['tenant', 'question_hash'], unique=False)
+    # every query of the questions filters on the tenant, the single column indexes would only slow the writes down
+    op.drop_index('ix_questions_category_id', table_name='questions')
+    op.drop_index('ix_questions_question_hash', table_name='questions')
+
+    # the same player name in two tenants is two players
+    op.drop_index('ix_player_scores_correct', table_name='player_scores')
+    with op.batch_alter_table('player_scores') as batch_op:
+        batch_op.add_column(_tenant_column())
+        if op.get_bind().dialect.name == 'postgresql':
+            batch_op.drop_constraint('player_scores_pkey', type_='primary')
+        batch_op.create_primary_key('player_scores_pkey', ['tenant', 'player'])
+    op.create_index('ix_player_scores_tenant_correct', 'player_scores', ['tenant', 'correct'], unique=False)
+
+    # and the rollup of a question is keyed by its tenant, like the other tenant queries
+    with op.batch_alter_table('question_stats') as batch_op:
+        batch_op.add_column(_tenant_column())
+        if op.get_bind().dialect.name == 'postgresql':
+            batch_op.drop_constraint('question_stats_pkey', type_='primary')
+        batch_op.create_primary_key('question_stats_pkey', ['tenant', 'question_id'])
+
+    _create_category_stats(STATS_QUERY, with_tenant=True)
+
+
+def downgrade():
+    _drop_category_stats()
+
+    # the question ids are unique across the tenants, the rollups don't need merging
+    with op.batch_alter_table('question_stats') as batch_op:
+        if op.get_bind().dialect.name == 'postgresql':
+            batch_op.drop_constraint('question_stats_pkey', type_='primary')
+        batch_op.drop_column('tenant')
+        batch_op.create_primary_key('question_stats_pkey', ['question_id'])
+
+    # the scores of a player in several tenants are merged back
+    op.drop_index('ix_player_scores_tenant_correct', table_name='player_scores')
+    op.execute(
+        "CREATE TABLE player_scores_merged AS "
+        "SELECT player, sum(answered) AS answered, sum(correct) AS correct FROM player_scores GROUP BY player"
+    )
+    op.execute("DELETE FROM player_scores")
+    with op.batch_alter_table('player_scores') as batch_op:
+        if op.get_bind().dialect.name == 'postgresql':
+            batch_op.drop_constraint('player_scores_pkey', type_='primary')
+        batch_op.drop_column('tenant')
+        batch_op.create_primary_key('player_scores_pkey', ['player'])
+    op.execute(
+        "INSERT INTO player_scores (player, answered, correct) "
+        "SELECT player, answered, correct FROM player_scores_merged"
+    )
+    op.drop_table('player_scores_merged')
+    op.create_index(op.f('ix_player_scores_correct'), 'player_scores', ['correct'], unique=False)
+
+    op.create_index('ix_questions_question_hash', 'questions', ['question_hash'], unique=False)
+    op.create_index('ix_questions_category_id', 'questions', ['category_id'], unique=False)
+    op.drop_index('ix_questions_tenant_question_hash', table_name='questions')
+    op.drop_index('ix_questions_tenant_category_id', table_name='questions')
+    op.drop_index('ix_categories_tenant_id', table_name='categories')
+    for table in reversed(TENANT_TABLES):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('tenant')
+
+    _create_category_stats(PREVIOUS_STATS_QUERY, with_tenant=False)
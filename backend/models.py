@@ -1,12 +1,30 @@
+import hashlib
+import json
 import os
+import re
+import unicodedata
 
 from flask_sqlalchemy import SQLAlchemy, BaseQuery
 from sqlalchemy import (
     Column, String,
-    Integer, ForeignKey
+    Integer, ForeignKey,
+    Boolean, DateTime,
+    BigInteger, SmallInteger,
+    Float, Text
 )
+from sqlalchemy.orm import validates
+from sqlalchemy.schema import Index
+
+from backend.green import is_green
 
 db = SQLAlchemy()
+# the tenant of the rows written before multi-tenancy and of the requests without a tenant
+DEFAULT_TENANT = 'default'
+
+
+def tenant_column():
+    # a server default, so the rows inserted without a tenant (like the init migration ones) belong to the default one
+    return Column(String(63), nullable=False, server_default=DEFAULT_TENANT)
 
 
 def setup_db(app, db_secrets=None):
@@ -25,6 +43,15 @@ def setup_db(app, db_secrets=None):
         db_name = db_secrets.get('name')
         db_uri = f"postgresql://{user}:{_pass}@{host}:{port}/{db_name}"
 
+        # in green mode thousands of greenlets share the pool, they wait for a connection without blocking the worker
+        # so the pool is bigger and the wait longer, but it has to stay under the server max_connections
+        green = is_green()
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+            'pool_size': int(app.config.get('DB_POOL_SIZE', 20 if green else 5)),
+            'max_overflow': int(app.config.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': float(app.config.get('DB_POOL_TIMEOUT', 60 if green else 30)),
+        })
+
     app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
@@ -41,21 +68,46 @@ class Question(db.Model):
     query: BaseQuery
 
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_tenant_category_id', 'tenant', 'category_id'),
+        Index('ix_questions_tenant_question_hash', 'tenant', 'question_hash'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
     category_id = Column(
         Integer,
-        ForeignKey('categories.id', ondelete='CASCADE')
+        ForeignKey('categories.id', ondelete='CASCADE'),
     )
     difficulty = Column(Integer)
+    # hash of the normalized question text, to find the exact duplicates
+    question_hash = Column(String(40))
+    tenant = tenant_column()
 
-    def __init__(self, question, answer, category_id, difficulty):
+    def __init__(self, question, answer, category_id, difficulty, tenant=DEFAULT_TENANT):
         self.question = question
         self.answer = answer
         self.category_id = category_id
         self.difficulty = difficulty
+        self.tenant = tenant
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """
+        lowercase text without punctuation and repeated spaces, so trivial edits don't hide a duplicate
+        """
+        text = unicodedata.normalize('NFKC', text or '').casefold()
+        return ' '.join(re.sub(r'[\W_]+', ' ', text).split())
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha1(Question.normalize_text(text).encode()).hexdigest()
+
+    @validates('question')
+    def validate_question(self, key, question):
+        self.question_hash = self.hash_text(question)
+        return question
 
     def insert(self):
         db.session.add(self)
@@ -69,6 +121,9 @@ class Question(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    # the keys of format()
+    COLUMNS = ('id', 'question', 'answer', 'category', 'difficulty')
+
     def format(self):
         return {
             'id': self.id,
@@ -87,9 +142,14 @@ class Category(db.Model):
     query: BaseQuery
 
     __tablename__ = 'categories'
+    __table_args__ = (
+        Index('ix_categories_tenant_id', 'tenant', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     type = Column(String)
+    # after type, the init migration inserts the categories by position
+    tenant = tenant_column()
     questions = db.relationship(
         'Question',
         lazy=True,
@@ -98,11 +158,218 @@ class Category(db.Model):
     )
 
     # noinspection PyShadowingBuiltins
-    def __init__(self, type):
+    def __init__(self, type, tenant=DEFAULT_TENANT):
         self.type = type
+        self.tenant = tenant
 
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+class CategoryStats(db.Model):
+    """
+    CategoryStats
+        questions count, average difficulty and difficulty histogram per category, a materialized view on PostgreSQL
+        and a table elsewhere, both refreshed in the background by CategoryStatsRefresher after writes to questions
+    """
+    query: BaseQuery
+
+    __tablename__ = 'category_stats'
+    __table_args__ = {'info': {'is_view': True}}
+
+    category_id = Column(Integer, primary_key=True, autoincrement=False)
+    tenant = Column(String(63), nullable=False)
+    type = Column(String)
+    questions = Column(Integer, nullable=False)
+    average_difficulty = Column(Float)
+    difficulty_1 = Column(Integer, nullable=False)
+    difficulty_2 = Column(Integer, nullable=False)
+    difficulty_3 = Column(Integer, nullable=False)
+    difficulty_4 = Column(Integer, nullable=False)
+    difficulty_5 = Column(Integer, nullable=False)
+
+    COLUMNS = ('id', 'type', 'total_questions', 'average_difficulty', 'difficulties')
+
+    def format(self):
+        return {
+            'id': self.category_id,
+            'type': self.type,
+            'total_questions': self.questions,
+            'average_difficulty': round(self.average_difficulty, 2) if self.average_difficulty is not None else None,
+            'difficulties': {
+                str(difficulty): getattr(self, f"difficulty_{difficulty}") for difficulty in range(1, 6)
+            },
+        }
+
+
+class QuestionBand(db.Model):
+    """
+    QuestionBand
+        locality sensitive hashing buckets of a question MinHash signature,
+        questions sharing a (band, bucket) are candidates to be near duplicates
+    """
+    query: BaseQuery
+
+    __tablename__ = 'question_bands'
+
+    band = Column(SmallInteger, primary_key=True, autoincrement=False)
+    bucket = Column(BigInteger, primary_key=True, autoincrement=False)
+    question_id = Column(
+        Integer,
+        ForeignKey('questions.id', ondelete='CASCADE'),
+        primary_key=True,
+        index=True
+    )
+
+    def __init__(self, band, bucket, question_id):
+        self.band = band
+        self.bucket = bucket
+        self.question_id = question_id
+
+
+class AnswerEvent(db.Model):
+    """
+    AnswerEvent
+        append only log of the answers posted by quiz clients, it's written in batches by AnswerBuffer
+    """
+    query: BaseQuery
+
+    __tablename__ = 'answer_events'
+
+    id = Column(Integer, primary_key=True)
+    question_id = Column(Integer, nullable=False)
+    player = Column(String, nullable=False)
+    correct = Column(Boolean, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    tenant = tenant_column()
+
+    def __init__(self, question_id, player, correct, created_at, tenant=DEFAULT_TENANT):
+        self.question_id = question_id
+        self.player = player
+        self.correct = correct
+        self.created_at = created_at
+        self.tenant = tenant
+
+    def format(self):
+        return {
+            'id': self.id,
+            'question_id': self.question_id,
+            'player': self.player,
+            'correct': self.correct,
+            'created_at': self.created_at.isoformat(),
+        }
+
+
+class QuestionStats(db.Model):
+    """
+    QuestionStats
+        answers rollup per question of every tenant, updated with every flushed batch of answer events
+    """
+    query: BaseQuery
+
+    __tablename__ = 'question_stats'
+
+    tenant = Column(String(63), primary_key=True, server_default=DEFAULT_TENANT)
+    question_id = Column(Integer, primary_key=True, autoincrement=False)
+    answered = Column(Integer, nullable=False)
+    correct = Column(Integer, nullable=False)
+
+    def __init__(self, question_id, answered, correct, tenant=DEFAULT_TENANT):
+        self.tenant = tenant
+        self.question_id = question_id
+        self.answered = answered
+        self.correct = correct
+
+    COLUMNS = ('question_id', 'answered', 'correct', 'accuracy')
+
+    def format(self):
+        return {
+            'question_id': self.question_id,
+            'answered': self.answered,
+            'correct': self.correct,
+            'accuracy': self.correct / self.answered if self.answered else None,
+        }
+
+
+class PlayerScore(db.Model):
+    """
+    PlayerScore
+        answers rollup per player of every tenant, the leaderboards are read from it
+    """
+    query: BaseQuery
+
+    __tablename__ = 'player_scores'
+    __table_args__ = (
+        Index('ix_player_scores_tenant_correct', 'tenant', 'correct'),
+    )
+
+    tenant = Column(String(63), primary_key=True, server_default=DEFAULT_TENANT)
+    player = Column(String, primary_key=True)
+    answered = Column(Integer, nullable=False)
+    correct = Column(Integer, nullable=False)
+
+    def __init__(self, player, answered, correct, tenant=DEFAULT_TENANT):
+        self.tenant = tenant
+        self.player = player
+        self.answered = answered
+        self.correct = correct
+
+    COLUMNS = ('player', 'answered', 'score')
+
+    def format(self):
+        return {
+            'player': self.player,
+            'answered': self.answered,
+            'score': self.correct,
+        }
+
+
+class Job(db.Model):
+    """
+    Job
+        a maintenance operation run in the background by JobQueue, in chunks of one transaction each,
+        its progress is committed with every chunk
+    """
+    query: BaseQuery
+
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    params = Column(Text, nullable=False)
+    # queued, running, done or failed
+    status = Column(String, nullable=False, index=True)
+    progress = Column(Integer, nullable=False)
+    total = Column(Integer)
+    error = Column(Text)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    tenant = tenant_column()
+
+    def __init__(self, kind, params, created_at, tenant=DEFAULT_TENANT):
+        self.tenant = tenant
+        self.kind = kind
+        self.params = json.dumps(params)
+        self.status = 'queued'
+        self.progress = 0
+        self.created_at = created_at
+
+    COLUMNS = ('id', 'kind', 'params', 'status', 'progress', 'total', 'error', 'created_at', 'started_at', 'finished_at')
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': json.loads(self.params),
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
@@ -0,0 +1,52 @@
+"""
+Green threads serving mode, every request runs in a greenlet and yields while it waits on PostgreSQL,
+so one worker serves thousands of concurrent requests instead of a thread per request.
+
+    # from the main repository directory
+    python -m backend.serve_gevent --port 5000
+    # or with gunicorn, one process per core
+    gunicorn -k gevent --worker-connections 2000 -w 4 backend.serve_gevent:app
+"""
+from gevent import monkey
+
+# it has to happen before anything else imports socket, threading or ssl
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+
+from backend.green import patch_psycopg  # noqa: E402
+
+patch_psycopg()
+
+from backend.flaskr import create_app  # noqa: E402
+
+# same default as .flaskenv, relative to the app folder
+os.environ.setdefault('APP_SETTINGS', '.env')
+app = create_app()
+
+
+def serve(host: str, port: int, connections: int = 2000):
+    """
+    serve(host, port)
+        serves app until the process is stopped, running at most connections requests at once
+    """
+    from gevent.pywsgi import WSGIServer
+
+    # warming up right away, instead of with the first request
+    app.extensions['warmup'].start()
+    print(f" * Serving with gevent on http://{host}:{port}")
+    WSGIServer((host, port), app, spawn=connections).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the trivia API with gevent.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--connections', type=int, default=2000, help='Max concurrent connections.')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.connections)
+
+
+if __name__ == '__main__':
+    main()
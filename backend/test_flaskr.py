@@ -1,12 +1,22 @@
+import json
 import os
+import tempfile
 import unittest
 from pathlib import Path
 
+import msgpack
 from flask.wrappers import Response
 from flask_migrate import Migrate, upgrade, downgrade
 from flask_sqlalchemy import SQLAlchemy
 
 from .flaskr import create_app
+from .flaskr.cache import FileBackend, MemoryBackend, ResultCache, TenantCaches
+from .flaskr.dedupe import MAX_CANDIDATES, find_similar, index_batches, similar_candidates
+from .flaskr.perf import audit_plan
+from .flaskr.seed import bulk_load, large_load, take_snapshot, restore_snapshot, drop_snapshot
+from .flaskr.snapshots import SnapshotPublisher
+from .flaskr.stats import refresh_category_stats
+from .flaskr.tenants import resolve_tenant
 from .models import setup_db, Question, Category
 
 backend_path = Path(__file__).parent
@@ -15,6 +25,7 @@ migrations_path = Path(backend_path, 'migrations')
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
+    migrated = False
 
     def setUp(self):
         """Define test variables and initialize app."""
@@ -27,13 +38,23 @@ class TriviaTestCase(unittest.TestCase):
                 'name': os.getenv('DB_NAME')
             })
             self.f_migrate = Migrate(self.app, self.db, directory=migrations_path)
-            upgrade(directory=migrations_path)
-
-    def tearDown(self):
-        """Executed after reach test"""
+            # migrating and seeding once, then every test starts from a snapshot of the seeded database
+            if not TriviaTestCase.migrated or not restore_snapshot():
+                # from scratch, a previous run may have stopped before tearDownClass
+                downgrade(directory=migrations_path, revision='base')
+                upgrade(directory=migrations_path)
+                take_snapshot()
+                TriviaTestCase.migrated = True
+            self.db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Executed after all the tests"""
         # drop all tables after finishing
-        with self.app.app_context():
-            downgrade(directory=migrations_path)
+        app = create_app(test_env='.env.test')
+        with app.app_context():
+            drop_snapshot()
+            downgrade(directory=migrations_path, revision='base')
 
     """
     DONE
@@ -84,6 +105,43 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(questions), 10, "Total Questions per page isn't 10")
         self.assertEqual(total_questions, 19, "total Question isn't 19")
 
+    def test_can_get_questions_as_msgpack(self):
+        res: Response = self.client().get('/api/questions', headers={'Accept': 'application/msgpack'})
+
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        self.assertEqual(res.mimetype, 'application/msgpack')
+        self.assertIn('Accept', res.headers.get('Vary'))
+        self.assertEqual(msgpack.unpackb(res.get_data()), self.client().get('/api/questions').get_json())
+
+    def test_can_get_questions_in_columnar_layout(self):
+        res: Response = self.client().get(
+            '/api/questions?layout=columnar', headers={'Accept': 'application/msgpack'}
+        )
+        questions: dict = msgpack.unpackb(res.get_data()).get('questions')
+        rows: list = self.client().get('/api/questions').get_json().get('questions')
+
+        self.assertEqual(questions['id'], [q['id'] for q in rows])
+        self.assertEqual(questions['difficulty'], [q['difficulty'] for q in rows])
+
+    def test_empty_lists_keep_their_columns_in_columnar_layout(self):
+        res: Response = self.client().post(
+            '/api/questions/search?layout=columnar', json={'q': 'no question has this in its text'}
+        )
+        questions: dict = res.get_json().get('questions')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(questions, {column: [] for column in Question.COLUMNS})
+        # the second time from the search cache
+        res = self.client().post(
+            '/api/questions/search?layout=columnar', json={'q': 'no question has this in its text'}
+        )
+        self.assertEqual(res.get_json().get('questions'), questions)
+
+        res = self.client().post('/api/questions?layout=columnar', json={
+            'question': 'A question unlike any other one?', 'answer': 'Yes', 'category': 1, 'difficulty': 1,
+        })
+        self.assertEqual(res.get_json().get('similar_questions'), {'id': [], 'similarity': []})
+
     def test_can_get_another_page_of_questions(self):
         res: Response = self.client().get('/api/questions?page=2')
         res_data: dict = res.get_json()
@@ -179,6 +237,34 @@ class TriviaTestCase(unittest.TestCase):
         message = "Difficulty range is between 1 to 5."
         self.assertEqual(res_data.get('message'), message)
 
+    def test_cant_create_an_exact_duplicate_question(self):
+        data = {
+            "question": "who discovered  PENICILLIN",
+            "answer": "Alexander Fleming",
+            "category": 1,
+            "difficulty": 3,
+        }
+        res: Response = self.client().post("/api/questions", json=data)
+        res_data: dict = res.get_json()
+
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422 unprocessable entity")
+        self.assertEqual(res_data.get('message'), "Question already exists. ")
+
+    def test_create_a_near_duplicate_question_reports_it(self):
+        self.app.config['DEDUPE_SIMILARITY'] = 0.7
+        data = {
+            "question": "Who has discovered penicillin?",
+            "answer": "Alexander Fleming",
+            "category": 1,
+            "difficulty": 3,
+        }
+        res: Response = self.client().post("/api/questions", json=data)
+        res_data: dict = res.get_json()
+
+        self.assertEqual(res.status_code, 201, "Response status code isn't 201 created")
+        similar_ids = [s['id'] for s in res_data.get('similar_questions')]
+        self.assertIn(17, similar_ids, "The similar question wasn't reported")
+
     def test_can_search_questions(self):
         data = {
             "q": "Indian"
@@ -209,6 +295,27 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res_data.get('current_category'), None, 'Current category should be empty when requesting all')
 
+    def test_search_cache_is_invalidated_after_writes(self):
+        data = {
+            "q": "French Revolution"
+        }
+        res: Response = self.client().post("/api/questions/search", json=data)
+        self.assertEqual(res.get_json().get('total_questions'), 0)
+
+        question = {
+            "question": "When did the French Revolution end?",
+            "answer": "1799",
+            "category": 4,
+            "difficulty": 2,
+        }
+        _id = self.client().post("/api/questions", json=question).get_json().get('id')
+        res: Response = self.client().post("/api/questions/search", json={"q": "french revolution"})
+        self.assertEqual(res.get_json().get('total_questions'), 1, "Cached search result wasn't invalidated on insert")
+
+        self.client().delete(f"/api/questions/{_id}")
+        res: Response = self.client().post("/api/questions/search", json=data)
+        self.assertEqual(res.get_json().get('total_questions'), 0, "Cached search result wasn't invalidated on delete")
+
     def test_can_get_questions_by_category(self):
         _id = 1
         res: Response = self.client().get(f"/api/categories/{_id}/questions")
@@ -306,6 +413,425 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(question, None)
 
 
+    def test_can_post_answers_and_read_rollups(self):
+        data = {
+            'player': 'abdo',
+            'answers': [
+                {'question_id': 16, 'correct': True},
+                {'question_id': 17, 'correct': False},
+            ]
+        }
+        res: Response = self.client().post("/api/quizzes/answers", json=data)
+        self.assertEqual(res.status_code, 202, "Response status code isn't 202 accepted")
+        self.assertEqual(res.get_json().get('accepted'), 2)
+
+        self.client().post("/api/quizzes/answers", json={'player': 'sara', 'answers': [{'question_id': 17, 'correct': True}]})
+        self.app.extensions['answer_buffer'].flush()
+
+        leaderboard: list = self.client().get('/api/leaderboard').get_json().get('leaderboard')
+        self.assertEqual(leaderboard, [
+            {'player': 'abdo', 'answered': 2, 'score': 1},
+            {'player': 'sara', 'answered': 1, 'score': 1},
+        ])
+
+        res_data: dict = self.client().get('/api/questions/accuracy').get_json()
+        self.assertEqual(res_data.get('total_questions'), 2)
+        self.assertEqual([(q['id'], q['accuracy']) for q in res_data.get('questions')], [(17, 0.5), (16, 1.0)])
+
+    def test_cant_answer_unknown_questions_or_questions_of_another_tenant(self):
+        data = {'player': 'abdo', 'answers': [{'question_id': 16, 'correct': True}, {'question_id': 1000, 'correct': True}]}
+        res: Response = self.client().post("/api/quizzes/answers", json=data)
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422 unprocessable entity")
+        self.assertEqual(res.get_json().get('message'), "Questions 1000 don't exist.")
+
+        res = self.client().post("/api/quizzes/answers", json=data, headers={'X-Tenant': 'acme'})
+        self.assertEqual(res.get_json().get('message'), "Questions 16, 1000 don't exist.")
+        self.assertEqual(self.app.extensions['answer_buffer'].pending(), 0, "Unknown answers were queued")
+
+    def test_refused_answers_dont_stop_the_ingestion(self):
+        res: Response = self.client().post("/api/quizzes/answers", json={
+            'player': 'bad\u0000', 'answers': [{'question_id': 16, 'correct': True}]
+        })
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422 unprocessable entity")
+        self.assertEqual(self.client().get('/api/leaderboard?limit=-1').get_json().get('leaderboard'), [])
+
+        answer_buffer = self.app.extensions['answer_buffer']
+        answer_buffer.add('bad\x00', [(16, True)])
+        answer_buffer.add('abdo', [(17, True)])
+        self.assertEqual(answer_buffer.flush(), 0)
+        self.assertEqual((answer_buffer.pending(), answer_buffer.dropped), (0, 2), "Refused batch was kept")
+
+        answer_buffer.add('abdo', [(17, True)])
+        self.assertEqual(answer_buffer.flush(), 1, "Answers weren't written after a refused batch")
+
+    def test_answers_are_refused_when_the_buffer_is_full(self):
+        answer_buffer = self.app.extensions['answer_buffer']
+        answer_buffer.max_pending = 2
+        data = {'player': 'abdo', 'answers': [{'question_id': 16, 'correct': True}, {'question_id': 17, 'correct': True}]}
+        self.assertEqual(self.client().post("/api/quizzes/answers", json=data).status_code, 202)
+
+        res: Response = self.client().post("/api/quizzes/answers", json=data)
+        self.assertEqual(res.status_code, 503, "Response status code isn't 503 when the buffer is full")
+        self.assertIn('Retry-After', res.headers)
+        self.assertEqual(answer_buffer.pending(), 2, "Refused answers were queued")
+        answer_buffer.flush()
+
+    def test_cant_post_answers_without_player(self):
+        data = {
+            'answers': [{'question_id': 16, 'correct': True}]
+        }
+        res: Response = self.client().post("/api/quizzes/answers", json=data)
+        res_data: dict = res.get_json()
+
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422 unprocessable entity")
+        self.assertEqual(res_data.get('message'), "Player is required. ")
+
+    def test_can_batch_requests(self):
+        res: Response = self.client().post('/api/batch', json={'requests': [
+            {'path': '/api/categories'},
+            {'path': '/api/questions?page=2'},
+            {'method': 'POST', 'path': '/api/questions/search', 'body': {'q': 'title'}},
+            {'path': '/api/categories/100/questions'},
+        ]})
+        responses: list = res.get_json().get('responses')
+
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        self.assertEqual([r['status'] for r in responses], [200, 200, 200, 404])
+        self.assertEqual(responses[0]['body'], self.client().get('/api/categories').get_json())
+        self.assertEqual(responses[1]['body'], self.client().get('/api/questions?page=2').get_json())
+        self.assertEqual(responses[2]['body'].get('total_questions'), 2)
+        self.assertEqual(responses[3]['body'].get('message'), "Not found.")
+
+    def test_cant_batch_too_many_or_nested_requests(self):
+        res: Response = self.client().post('/api/batch', json={'requests': [{'path': '/api/categories'}] * 11})
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422")
+
+        res = self.client().post('/api/batch', json={'requests': [{'method': 'POST', 'path': '/api/batch'}]})
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422")
+        self.assertEqual(res.get_json().get('message'), "/api/batch can't be batched.")
+
+        nested = (('POST', '/api/%62atch'), ('GET', '/api/%61dmin/slow-queries'), ('GET', '/api/admin/profiles/1'))
+        for method, path in nested:
+            res = self.client().post('/api/batch', json={'requests': [{'method': method, 'path': path}]})
+            self.assertEqual(res.status_code, 422, f"{path} was batched")
+
+    def test_failed_batch_requests_dont_fail_the_next_ones(self):
+        # respond with 500 like in production instead of raising the error of the sub-request
+        self.app.config['PROPAGATE_EXCEPTIONS'] = False
+        res: Response = self.client().post('/api/batch', json={'requests': [
+            {'path': '/api/categories/abc/questions'},
+            {'path': '/api/categories'},
+            {'path': '/api/questions?page=2'},
+        ]})
+        statuses: list = [r['status'] for r in res.get_json().get('responses')]
+
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        self.assertNotEqual(statuses[0], 200)
+        self.assertEqual(statuses[1:], [200, 200])
+
+    def test_can_delete_category_in_a_job(self):
+        res: Response = self.client().delete('/api/categories/1')
+        job: dict = res.get_json().get('job')
+
+        self.assertEqual(res.status_code, 202, "Response status code isn't 202 accepted")
+        self.assertEqual(job.get('status'), 'queued')
+        self.app.extensions['jobs'].wait(job['id'])
+
+        job = self.client().get(f"/api/jobs/{job['id']}").get_json().get('job')
+        self.assertEqual(job.get('status'), 'done', job.get('error'))
+        self.assertEqual((job.get('progress'), job.get('total')), (3, 3))
+        self.assertEqual(self.client().get('/api/categories/1/questions').status_code, 404)
+        self.assertEqual(self.client().get('/api/questions').get_json().get('total_questions'), 16)
+
+    def test_can_recategorize_questions_in_a_job(self):
+        self.app.extensions['jobs'].batch_size = 2
+        res: Response = self.client().post('/api/jobs', json={
+            'kind': 'recategorize', 'params': {'from_category_id': 1, 'to_category_id': 2},
+        })
+        job_id = res.get_json().get('job').get('id')
+        self.app.extensions['jobs'].wait(job_id)
+
+        self.assertEqual(self.client().get(f"/api/jobs/{job_id}").get_json().get('job').get('status'), 'done')
+        self.assertEqual(self.client().get('/api/categories/1/questions').get_json().get('total_questions'), 0)
+        self.assertEqual(self.client().get('/api/categories/2/questions').get_json().get('total_questions'), 7)
+
+    def test_cant_start_an_invalid_job(self):
+        res: Response = self.client().post('/api/jobs', json={'kind': 'recategorize', 'params': {
+            'from_category_id': 1, 'to_category_id': 100,
+        }})
+
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422")
+        self.assertEqual(res.get_json().get('message'), "Category 100 doesn't exist.")
+
+        res = self.client().post('/api/jobs', json={'kind': 'recategorize', 'params': {
+            'from_category_id': 1, 'to_category_id': 1,
+        }})
+        self.assertEqual(res.status_code, 422, "Response status code isn't 422")
+        self.assertEqual(
+            res.get_json().get('message'), "from_category_id and to_category_id should be different."
+        )
+
+    def test_liveness_doesnt_wait_for_the_warm_up(self):
+        res: Response = self.client().get('/api/health/live')
+
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        self.assertFalse(self.app.extensions['warmup'].ready)
+
+    def test_ready_after_the_warm_up(self):
+        res: Response = self.client().get('/api/health/ready')
+        self.assertEqual(res.status_code, 503, "Response status code isn't 503 before warming up")
+
+        self.assertTrue(self.app.extensions['warmup'].wait(10), "Warm up didn't finish")
+        res = self.client().get('/api/health/ready')
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        self.assertTrue(res.get_json().get('ready'))
+        search_cache = self.app.extensions['search_cache']
+        self.assertIsNotNone(
+            search_cache.get('default', search_cache.key('default', '', 1)), "Search cache wasn't primed"
+        )
+
+    def test_signed_requests_are_profiled(self):
+        profiler = self.app.extensions['profiler']
+        profiler.interval = 0.0005
+        token = self.app.test_cli_runner().invoke(args=['perf', 'profile-token']).output.strip()
+        headers = {'X-Profile-Token': token}
+
+        self.client().post('/api/batch', headers=headers, json={'requests': [
+            {'path': '/api/questions'}, {'path': '/api/categories'}, {'path': '/api/questions?page=2'},
+            {'path': '/api/categories/1/questions'}, {'path': '/api/questions/accuracy'},
+        ]})
+        self.client().get('/api/questions')
+
+        res: Response = self.client().get('/api/admin/profiles', headers=headers)
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        profiles = res.get_json().get('profiles')
+        self.assertEqual([p['path'] for p in profiles], ['/api/batch'], "Only the signed request is profiled")
+        self.assertGreater(profiles[0]['queries'], 0, "SQL queries weren't recorded")
+
+        res = self.client().get(f"/api/admin/profiles/{profiles[0]['id']}?format=json", headers=headers)
+        profile = res.get_json()
+        self.assertGreater(profile['samples'], 0, "Stacks weren't sampled")
+        self.assertTrue(all(q['statement'] and q['duration_ms'] >= 0 for q in profile['sql']))
+        res = self.client().get(f"/api/admin/profiles/{profiles[0]['id']}", headers=headers)
+        self.assertEqual(res.mimetype, 'text/plain')
+        counts = [int(line.rsplit(' ', 1)[1]) for line in res.get_data(as_text=True).splitlines()]
+        self.assertEqual(sum(counts), profile['samples'], "Folded stacks don't have every sample")
+
+    def test_cant_list_profiles_without_a_signed_token(self):
+        res: Response = self.client().get('/api/admin/profiles', headers={'X-Profile-Token': 'not signed'})
+        res_data: dict = res.get_json()
+
+        self.assertEqual(res.status_code, 404, "Response status code isn't 404 not found")
+        self.assertEqual(res_data.get("message"), "Not found.", "Response doesn't have a not found message")
+
+    def test_slow_queries_are_recorded_by_fingerprint(self):
+        slow_queries = self.app.extensions['slow_queries']
+        slow_queries.threshold_ms = 0
+        slow_queries.explain = False
+
+        self.client().post("/api/questions/search", json={"q": "secret term"})
+        self.client().post("/api/questions/search", json={"q": "another secret"})
+
+        summary = slow_queries.summary()
+        searches = [s for s in summary['fingerprints'] if 'POST /api/questions/search' in s['routes']]
+        self.assertTrue(searches, "Search queries weren't recorded")
+        self.assertTrue(all(s['count'] == 2 for s in searches), "Same queries don't share a fingerprint")
+        for entry in summary['recent']:
+            self.assertNotIn('secret', str(entry['parameters']), "Query parameters aren't redacted")
+
+    def test_bulk_load_keeps_empty_strings_and_only_defers_large_loads(self):
+        with self.app.app_context():
+            bulk_load(Question.__table__, ['question', 'answer', 'category_id', 'difficulty'], [
+                ('Bulk, "quoted"\nquestion?', '', 1, 1), ('Bulk question?', None, 1, 1),
+            ])
+            answers = dict(self.db.session.query(Question.question, Question.answer).filter(
+                Question.question.like('Bulk%')
+            ).all())
+            self.db.session.rollback()
+
+            self.assertEqual(answers, {'Bulk, "quoted"\nquestion?': '', 'Bulk question?': None})
+            self.assertFalse(large_load(Question.__table__, 1000, existing_rows=0))
+            self.assertTrue(large_load(Question.__table__, 20000, existing_rows=19))
+            self.assertFalse(large_load(Question.__table__, 20000, existing_rows=100000))
+
+    def test_snapshots_are_the_api_responses(self):
+        with tempfile.TemporaryDirectory() as directory:
+            publisher = SnapshotPublisher(self.app, directory, pages=3)
+            publisher.publish_all()
+
+            with open(Path(directory, 'api', 'questions', 'page-2.json')) as f:
+                self.assertEqual(json.load(f), self.client().get('/api/questions?page=2').get_json())
+            self.assertFalse(Path(directory, 'api', 'questions', 'page-3.json').exists(), "Empty page was published")
+            with open(Path(directory, 'api', 'categories', '1', 'questions', 'page-1.json')) as f:
+                self.assertEqual(json.load(f).get('total_questions'), 3)
+
+            self.client().delete('/api/questions/1')
+            publisher.publish({4})
+            with open(Path(directory, 'api', 'questions', 'page-2.json')) as f:
+                self.assertEqual(json.load(f).get('total_questions'), 18, "Page wasn't published again")
+
+    def test_can_get_categories_stats(self):
+        res: Response = self.client().get('/api/categories/stats')
+        res_data: dict = res.get_json()
+
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        stats = {c['id']: c for c in res_data.get('categories')}
+        self.assertEqual(len(stats), 6, "Stats don't have every category")
+        self.assertEqual(sum(c['total_questions'] for c in stats.values()), 19)
+        self.assertEqual(stats[1]['total_questions'], sum(stats[1]['difficulties'].values()))
+
+        self.client().delete('/api/questions/1')
+        with self.app.app_context():
+            refresh_category_stats({4})
+        stats = {c['id']: c for c in self.client().get('/api/categories/stats').get_json().get('categories')}
+        self.assertEqual(sum(c['total_questions'] for c in stats.values()), 18, "Stats weren't refreshed")
+
+    def test_tenants_have_their_own_question_banks(self):
+        with self.app.app_context():
+            category = Category('Acme', tenant='acme')
+            self.db.session.add(category)
+            self.db.session.flush()
+            self.db.session.add(Question('Acme question?', 'Acme answer', category.id, 2, tenant='acme'))
+            self.db.session.commit()
+            category_id = category.id
+        acme = {'X-Tenant': 'acme'}
+
+        res: Response = self.client().get('/api/questions', headers=acme)
+        self.assertEqual(res.status_code, 200, "Response status code isn't 200 ok")
+        self.assertEqual(res.get_json().get('total_questions'), 1, "Questions of other tenants were listed")
+        self.assertEqual(res.get_json().get('categories'), {str(category_id): 'Acme'})
+        self.assertEqual(self.client().get('/api/questions').get_json().get('total_questions'), 19)
+
+        res = self.client().post('/api/questions/search', json={'q': 'question'}, headers=acme)
+        self.assertEqual(res.get_json().get('total_questions'), 1, "Search wasn't scoped by tenant")
+        res = self.client().get(f"/api/categories/{category_id}/questions")
+        self.assertEqual(res.status_code, 404, "Category of another tenant was found")
+        res = self.client().delete('/api/questions/1', headers=acme)
+        self.assertEqual(res.status_code, 404, "Question of another tenant was deleted")
+        res = self.client().post('/api/questions', headers=acme, json={
+            'question': 'Another acme question?', 'answer': 'Yes', 'category': 1, 'difficulty': 1,
+        })
+        self.assertEqual(res.status_code, 422, "Question was added to a category of another tenant")
+
+        res = self.client().get('/api/questions', headers={'X-Tenant': '../etc'})
+        self.assertEqual(res.status_code, 404, "Invalid tenant wasn't rejected")
+
+    def test_writes_only_invalidate_their_tenant_cache(self):
+        search_cache = self.app.extensions['search_cache']
+        self.client().post('/api/questions/search', json={'q': 'title'})
+        with self.app.app_context():
+            category = Category('Acme', tenant='acme')
+            self.db.session.add(category)
+            self.db.session.flush()
+            self.db.session.add(Question('Acme title?', 'Acme answer', category.id, 2, tenant='acme'))
+            self.db.session.commit()
+
+        self.assertIsNotNone(
+            search_cache.get('default', search_cache.key('default', 'title', 1)),
+            "Write of another tenant invalidated the cache"
+        )
+        res = self.client().post('/api/questions/search', json={'q': 'title'}, headers={'X-Tenant': 'acme'})
+        self.assertEqual(res.get_json().get('total_questions'), 1)
+
+    def test_templated_questions_only_load_the_best_candidates(self):
+        with self.app.app_context():
+            for i in range(200):
+                self.db.session.add(Question(f"What is the capital of country number {i}?", 'Capital', 1, 1))
+            self.db.session.commit()
+            for _ in index_batches():
+                self.db.session.commit()
+
+            candidates = similar_candidates('What is the capital of country number 1000?', 'default').all()
+            similar = find_similar('What is the capital of country number 17?', 'default')
+
+        self.assertEqual(len(candidates), MAX_CANDIDATES, "Candidates weren't limited")
+        self.assertEqual(similar[0][1], 1.0, "The most similar question wasn't a candidate")
+
+    def test_fixture_bootstraps_a_tenant_with_new_category_ids(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as fixture:
+            json.dump({
+                'categories': [{'id': 1, 'type': 'Acme science'}],
+                'questions': [{'question': 'Acme question?', 'answer': 'Yes', 'category': 1, 'difficulty': 2}],
+            }, fixture)
+            fixture.flush()
+            result = self.app.test_cli_runner().invoke(args=['seed', 'fixture', fixture.name, '--tenant', 'acme'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        acme = {'X-Tenant': 'acme'}
+        res_data: dict = self.client().get('/api/questions', headers=acme).get_json()
+        [(category_id, category_type)] = res_data.get('categories').items()
+        self.assertNotEqual(category_id, '1', "Fixture category id was reused")
+        self.assertEqual(category_type, 'Acme science')
+        self.assertEqual([q['category'] for q in res_data.get('questions')], [int(category_id)])
+        self.assertEqual(self.client().get('/api/categories/1/questions').get_json().get('total_questions'), 3)
+
+    def test_unknown_tenants_share_a_cache_partition(self):
+        search_cache = self.app.extensions['search_cache']
+        for tenant in ['nobody', 'noone']:
+            res: Response = self.client().post(
+                '/api/questions/search', json={'q': 'title'}, headers={'X-Tenant': tenant}
+            )
+            self.assertEqual(res.get_json().get('total_questions'), 0)
+
+        with self.app.app_context():
+            self.assertNotIn('nobody', search_cache._partitions, "Unknown tenant got a cache partition")
+            self.assertEqual(search_cache.get('noone', search_cache.key('noone', 'title', 1))['total_questions'], 0)
+            self.assertIsNone(search_cache.get('acme', search_cache.key('acme', 'title', 1)))
+
+    def test_tenant_header_cant_contradict_the_subdomain(self):
+        with self.app.test_request_context(base_url='http://acme.trivia.test', headers={'X-Tenant': 'globex'}):
+            self.assertIsNone(resolve_tenant('trivia.test'))
+        with self.app.test_request_context(base_url='http://acme.trivia.test', headers={'X-Tenant': 'acme'}):
+            self.assertEqual(resolve_tenant('trivia.test'), 'acme')
+        with self.app.test_request_context(headers={'X-Tenant': 'globex'}):
+            self.assertEqual(resolve_tenant('trivia.test'), 'globex')
+
+    def test_plan_audit_only_flags_selective_scans(self):
+        def scan(condition, kept, removed):
+            return {
+                'Node Type': 'Seq Scan', 'Relation Name': 'questions', 'Filter': condition,
+                'Plan Rows': kept, 'Actual Rows': kept, 'Actual Loops': 1, 'Rows Removed by Filter': removed,
+            }
+        sizes = {'questions': 100000}
+
+        self.assertEqual(len(audit_plan(scan('(category_id = 1)', 10, 99990), sizes, 1000, 10)), 1)
+        self.assertEqual(audit_plan(scan("((tenant)::text = 'default'::text)", 100000, 0), sizes, 1000, 10), [],
+                         "Scan keeping every row was flagged")
+        self.assertEqual(audit_plan(scan("((question)::text ~~* '%rare%'::text)", 1, 99999), sizes, 1000, 10), [],
+                         "Unindexable filter was flagged")
+
+    def test_file_cache_is_private_json(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FileBackend(Path(directory, 'cache'), max_size=2)
+            backend.set('key', [1, {'questions': []}])
+            self.assertEqual(backend.get('key'), [1, {'questions': []}])
+            self.assertEqual(oct(Path(directory, 'cache').stat().st_mode & 0o777), oct(0o700))
+            version = backend.bump()
+            self.assertEqual(backend.version(), version)
+            self.assertEqual(FileBackend(Path(directory, 'cache')).version(), version, "Version isn't shared")
+
+            shared = Path(directory, 'shared')
+            shared.mkdir()
+            shared.chmod(0o777)
+            with self.assertRaises(PermissionError):
+                FileBackend(shared)
+
+    def test_noisy_tenant_only_evicts_its_own_cache_entries(self):
+        caches = TenantCaches(lambda tenant: ResultCache(MemoryBackend(2)), max_tenants=2)
+        caches.set('quiet', caches.key('quiet', 'q'), 'quiet page')
+        for page in range(10):
+            caches.set('noisy', caches.key('noisy', 'q', page), f"page {page}")
+
+        self.assertEqual(caches.get('quiet', caches.key('quiet', 'q')), 'quiet page')
+        self.assertIsNone(caches.get('noisy', caches.key('noisy', 'q', 0)), "Noisy tenant wasn't bounded")
+        self.assertEqual(caches.get('noisy', caches.key('noisy', 'q', 9)), 'page 9')
+
+        caches.bump({'noisy'})
+        self.assertEqual(caches.get('quiet', caches.key('quiet', 'q')), 'quiet page')
+        caches.bump(set())
+        self.assertIsNone(caches.get('quiet', caches.key('quiet', 'q')), "Cache wasn't invalidated")
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()